@@ -1,10 +1,10 @@
 from __future__ import annotations
 
-import json
 import logging
 import posixpath
-import tempfile
-from dataclasses import asdict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import IO, TYPE_CHECKING, List
 
 import os
@@ -13,7 +13,19 @@ from uuid import uuid4
 from calibre.devices.interface import DevicePlugin  # type: ignore
 from calibre.devices.usbms.deviceconfig import DeviceConfig  # type: ignore
 
-from . import rm_ssh, rm_web_interface
+from . import (
+    rm_cache,
+    rm_capabilities,
+    rm_metadata,
+    rm_prefetch,
+    rm_presence,
+    rm_progress,
+    rm_restart,
+    rm_ssh,
+    rm_ssh_upload,
+    rm_stats,
+    rm_web_interface,
+)
 from .log_helper import log_args_kwargs
 from .rm_data import (
     RemarkableBook,
@@ -28,17 +40,22 @@ if TYPE_CHECKING:
 PLUGIN_NAME = "remarkable-calibre-usb-device"
 print("----------------------------------- REMARKABLE PLUGIN web interface ------------------------")
 device = None
-logging.basicConfig(level=logging.DEBUG)
 LOGGER = logging.getLogger()
 
 RM_UUID = "#rm_uuid"
+RM_CONTENT_HASH = "#rm_content_hash"
 
 
 class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
     VENDOR_ID = 0x04B3
     PRODUCT_ID = 0x4010
 
-    progress = 0.0
+    # calibre's progress reporter
+    progress_reporter = None
+    # progress of the last upload, with its throughput and time left
+    upload_progress: rm_progress.Progress | None = None
+    # books of the last upload that were not sent, because the same content is already on the device
+    skipped_uploads: list[str] = []
     name = PLUGIN_NAME
     description = "Send epub and pdf files to Remarkable"
     author = "Andri Rakotomalala"
@@ -63,10 +80,27 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
         "IP address:::" "<p>" "Use this option if you want to force the driver to listen on a " "particular IP address." "</p>",
         # -----------
         "SSH password (optional):::" "<p>Required for folders support</p>",
+        # -----------
+        "Parallel uploads:::" "<p>" "Number of books transferred at the same time (SSH is required for more than 1)" "</p>",
+        # -----------
+        "Timing report (optional):::"
+        "<p>"
+        "Path of a JSON file reporting the number, size and duration of the operations sent to the device, for diagnosing slow transfers."
+        " Leave empty to disable"
+        "</p>",
+        # -----------
+        "Upload through SSH:::"
+        "<p>"
+        "Write the books directly on the device through SSH instead of the USB web interface."
+        " Interrupted transfers are resumed and every book is checked against its checksum"
+        "</p>",
     ]
     EXTRA_CUSTOMIZATION_DEFAULT = [  # type: ignore
         "10.11.99.1",
         "",
+        "2",
+        "",
+        False,
     ]
 
     def config_widget(self):
@@ -88,7 +122,24 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
     @classmethod
     def settings_obj(cls):
         settings = cls.settings()
-        return RemarkableSettings(*settings.extra_customization)
+        remarkable_settings = RemarkableSettings(*settings.extra_customization)
+        rm_stats.configure(remarkable_settings.TIMING_REPORT)
+        return remarkable_settings
+
+    @classmethod
+    def has_ssh(cls, settings: RemarkableSettings):
+        """
+        Test if ssh is working AND home is writable, using the cached capabilities of the connected device
+        """
+        if device is None:
+            return rm_ssh.test_connection(settings)
+        capabilities = rm_capabilities.get_capabilities(device, settings)
+        return capabilities.has_ssh and capabilities.is_writable
+
+    @classmethod
+    def has_web_interface(cls):
+        """Whether the web interface of the connected device answered the last time it was checked"""
+        return device is None or rm_capabilities.web_interface_status(device)
 
     @log_args_kwargs
     def startup(self):
@@ -109,10 +160,23 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
             LOGGER.warning("USB device not detected", exc_info=True)
 
         try:
-            if rm_web_interface.check_connection(settings.IP):
+            present, appeared = rm_presence.probe(settings.IP)
+            if not present:
+                return None
+            # keep the same description (and its cached capabilities) while the device stays connected
+            if appeared or device is None or device.ip != settings.IP:
+                # the web interface is only queried when the device shows up
+                if not rm_web_interface.check_connection(settings.IP):
+                    rm_presence.mark_absent(settings.IP)
+                    return None
+                if device is not None:
+                    rm_capabilities.invalidate(device)
                 device = RemarkableDeviceDescription(settings.IP)
+                rm_capabilities.set_web_interface_status(device, True)
                 LOGGER.info(f"detected {device=}")
-                return device
+                # books() comes next, have its data ready by then
+                rm_prefetch.start(device, settings, self.load_device_state)
+            return device
         except:  # noqa: E722
             LOGGER.warning("No device detected", exc_info=True)
             device = None
@@ -131,10 +195,19 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
         booklist0, _, _ = self.sync_booklists(booklists)
 
         settings = self.settings_obj()
-        device_paths = rm_web_interface.query_tree(settings.IP, "").ls_recursive_dict()
-        books = {path: uuid for path, uuid in device_paths.items() if path.startswith("Calibre")}
+
+        def is_calibre_folder(c: rm_web_interface.ChildNode):
+            # only the calibre folders are walked
+            return c.visible_name.startswith("Calibre")
+
+        if self.has_ssh(settings):
+            tree, _ = self.device_state(settings)
+            books = tree.filter_children(is_calibre_folder).ls_recursive_dict()
+        else:
+            tree = rm_web_interface.LazyNode(settings.IP)
+            books = rm_web_interface.load_recursive(settings.IP, tree.filter_children(is_calibre_folder)).ls_recursive_dict()
         booklist_final = booklist0
-        metadata_uuids = [book.rm_uuid for book in booklist_final]
+        metadata_uuids = {book.rm_uuid for book in booklist_final}
         for path, uuid in books.items():
             if uuid not in metadata_uuids:
                 path_parts = path.split("/")
@@ -161,62 +234,209 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
 
     @log_args_kwargs
     def upload_books(self, files_original, names, on_card=None, end_session=True, metadata: list[Metadata] = None):
-        locations = []
-        self.progress = 0.0
         settings = self.settings_obj()
+        # a restart requested by a previous operation must not happen while the device is used (listings, transfers)
+        with rm_progress.Progress(self.progress_reporter) as progress, rm_restart.scheduler_for(settings).hold():
+            self.upload_progress = progress
+            return self._upload_books(settings, files_original, names, metadata, progress)
 
+    def _upload_books(self, settings: RemarkableSettings, files_original, names, metadata: list[Metadata] | None, progress: rm_progress.Progress):
         if not metadata:
             metadata = [None] * len(files_original)
-        step = 100 / len(files_original)
-        has_ssh = rm_ssh.test_connection(settings)
-        existing_folders = rm_web_interface.query_tree(settings.IP, "").ls_dir_recursive_dict() if has_ssh else {}
+        sizes = {i: os.path.getsize(f) for i, f in enumerate(files_original)}
+        has_ssh = self.has_ssh(settings)
+        restart_scheduler = rm_restart.scheduler_for(settings)
+        # the previous operation may have restarted xochitl: wait for it before the first request to the web interface
+        web_interface_ready = restart_scheduler.wait_until_ready()
+        if not web_interface_ready:
+            LOGGER.warning("The web interface did not come back after restarting xochitl")
+        if device is not None:
+            rm_capabilities.set_web_interface_status(device, web_interface_ready)
+        # the web interface did not come back after the last restart: ssh is the only way left
+        upload_over_ssh = has_ssh and (settings.UPLOAD_OVER_SSH or not self.has_web_interface())
+
+        locations = [self._create_upload_path(m, visible_name) for visible_name, m in zip(names, metadata)]
+        # only the folders along the upload paths are fetched
+        existing_folders = rm_web_interface.LazyNode(settings.IP).dir_ids_along(locations) if has_ssh else {}
+        folder_ids = [""] * len(files_original)
+        content_hashes = [""] * len(files_original)
+        already_on_device: dict[int, RemarkableBook] = {}
         needs_reboot = False
-        for local_path, visible_name, m in zip(files_original, names, metadata):
-            folder_id = ""
-            folder_id_final = ""
-            is_new_folder = False
-            upload_path = self._create_upload_path(m, visible_name)
-            if has_ssh:
-                if upload_path:
-                    parts = upload_path.split("/")
-                    parts = parts[:-1]
-                    parent_folder_id = ""
-                    for i in range(len(parts)):
-                        part_full = "/".join(parts[: i + 1])
-                        LOGGER.debug(
-                            f"Looking if {part_full=} already exists on remarkable",
-                        )
-                        # FIXME: does not work when folder is new, and uploading multiple files at the same time
-                        folder_id_final = existing_folders.get(part_full)
-                        LOGGER.debug(f"{folder_id_final=}")
-                        if not folder_id_final:
-                            part_name = parts[i]
-                            folder_id_final = rm_ssh.mkdir(settings, part_name, parent_folder_id)
-                            existing_folders[part_full] = folder_id_final
-                            needs_reboot = True
-                            LOGGER.debug(f"after mkdir {folder_id_final=}")
-                            is_new_folder = True
-                        parent_folder_id = folder_id_final
-            locations.append(upload_path)
-
-            # FIXME: fails when author has special character ';'
-            rm_web_interface.upload_file(settings.IP, local_path, folder_id_final, visible_name)
-
-            if has_ssh:
-                file_uuid = rm_ssh.get_latest_upload_uuid(settings)
-                m.set_user_metadata(RM_UUID, {"#value#": file_uuid, "datatype": "text"})
-                rm_ssh.sed(settings, f"{file_uuid}.metadata", '"parent": ""', f'"parent": "{folder_id_final}"')
-                if is_new_folder:
+        if has_ssh:
+            progress.start_phase("Checking the books already on the device", 0.04, sizes)
+            for i, f in enumerate(files_original):
+                content_hashes[i] = rm_ssh_upload.sha256_file(f)
+                progress.update(i, sizes[i])
+            already_on_device = self.find_uploaded(settings, content_hashes, [m.get("uuid") if m is not None else None for m in metadata])
+
+            progress.start_phase("Creating the folders on the device", 0.05)
+
+            # all the missing folders of the batch are created at once, before any upload
+            plan = rm_ssh.plan_folders(locations, existing_folders)
+            LOGGER.debug(f"{plan=}")
+            folder_ids = plan.folder_ids
+            needs_reboot = len(plan.new_collections) > 0
+            folders_batch = rm_ssh.SshBatch(settings)
+            if plan.new_collections:
+                folders_batch.mkdirs(plan.new_collections)
+            # the documents that are already on the device are moved instead of uploaded again
+            for index, book in already_on_device.items():
+                if book.path != locations[index]:
+                    folders_batch.move_document(book.rm_uuid, folder_ids[index], self.visible_name(names[index]))
+                    needs_reboot = True
+            if not upload_over_ssh:
+                # documents created from now on are the uploads, see match_uploads
+                folders_batch.snapshot_documents()
+            for result in folders_batch.run():
+                if not result.ok:
+                    raise SystemError(f"Unable to prepare the upload: {result}")
+
+        self.skipped_uploads = [
+            f"{names[i]}: {'already on the device' if book.path == locations[i] else f'moved from {book.path}'}"
+            for i, book in already_on_device.items()
+        ]
+        if self.skipped_uploads:
+            LOGGER.info("Not uploaded, the same content is already on the device:\n" + "\n".join(self.skipped_uploads))
+
+        # FIXME: fails when author has special character ';'
+        to_upload = [i for i in range(len(files_original)) if i not in already_on_device]
+        uploads = [(files_original[i], folder_ids[i], names[i]) for i in to_upload]
+        # uploads are moved to their folder afterwards when ssh is available: parallel uploads skip the positioning
+        max_workers = settings.parallel_uploads() if has_ssh else 1
+        completion_lock = threading.Lock()
+        # indexes of the books (not of the uploads)
+        completion_order: list[int] = []
+
+        def on_upload_complete(index: int, result: rm_web_interface.UploadResult):
+            with completion_lock:
+                if result.ok:
+                    completion_order.append(to_upload[index])
+
+        def on_upload_progress(index: int, sent: int, total: int):
+            progress.update(index, sent, total)
+
+        progress.start_phase(f"Sending {len(uploads)} books to the device", 0.95, {index: sizes[i] for index, i in enumerate(to_upload)})
+        transfer_started_at = time.monotonic()
+
+        if upload_over_ssh:
+            checksums = [content_hashes[i] for i in to_upload]
+            results = rm_ssh_upload.upload_files(
+                settings,
+                uploads,
+                max_workers=max_workers,
+                on_complete=on_upload_complete,
+                checksums=checksums,
+                progress_callback=on_upload_progress,
+            )
+        else:
+            results = rm_web_interface.upload_files(
+                settings.IP, uploads, max_workers=max_workers, on_complete=on_upload_complete, progress_callback=on_upload_progress
+            )
+        duration = time.monotonic() - transfer_started_at
+        sent = sum(sizes[i] for i in completion_order)
+        rate = sent / max(duration, 1e-3)
+        LOGGER.info(f"Sent {len(completion_order)}/{len(uploads)} books, {sent / 1e6:.1f} MB in {duration:.1f}s ({rate / 1e6:.1f} MB/s)")
+
+        progress.start_phase("Updating the documents on the device", 1.0)
+
+        result_of = dict(zip(to_upload, results))
+        file_uuids: dict[int, str] = {}
+        if upload_over_ssh:
+            # the documents were created directly in their folder, xochitl has to be restarted to show them
+            file_uuids = {index: result_of[index].response for index in completion_order}
+            needs_reboot = needs_reboot or len(file_uuids) > 0
+        elif has_ssh and completion_order:
+            lookup_batch = rm_ssh.SshBatch(settings)
+            lookup_index = lookup_batch.new_documents()
+            file_uuids = self.match_uploads(lookup_batch.run()[lookup_index].output, names, completion_order)
+
+            fixup_batch = rm_ssh.SshBatch(settings)
+            for index, file_uuid in file_uuids.items():
+                fixup_batch.set_parent(file_uuid, folder_ids[index])
+            for result in fixup_batch.run():
+                if not result.ok:
+                    LOGGER.warning(f"Unable to move upload to its folder: {result}")
+                elif result.output.strip() == "moved":
+                    # xochitl keeps the document in the folder it was uploaded to until it is restarted
+                    # (always the case of the parallel uploads, which are not positioned)
                     needs_reboot = True
 
-            self.progress += step
+        file_uuids.update((index, book.rm_uuid) for index, book in already_on_device.items())
+        for index, file_uuid in file_uuids.items():
+            m = metadata[index]
+            if m is not None:
+                m.set_user_metadata(RM_UUID, {"#value#": file_uuid, "datatype": "text"})
+                m.set_user_metadata(RM_CONTENT_HASH, {"#value#": content_hashes[index], "datatype": "text"})
 
         if needs_reboot and has_ssh:
-            rm_ssh.xochitl_restart_after(settings, 5.0)
-        self.progress = 100.0
+            restart_scheduler.request_restart()
+        progress.finish("Books sent to the device")
+
+        failed = [f"{names[i]}: {r.error}" for i, r in result_of.items() if not r.ok]
+        if failed:
+            # calibre drops the locations of the whole job when it fails: the books that did make it are recorded
+            # on the device instead of add_books_to_metadata, so that they are not left untracked
+            if has_ssh:
+                self.record_uploaded_books(settings, [(locations[i], metadata[i]) for i in sorted(file_uuids) if metadata[i] is not None])
+            raise SystemError(f"Unable to upload {len(failed)}/{len(files_original)} books:\n" + "\n".join(failed))
 
         return (locations, metadata, None)
 
+    def record_uploaded_books(self, settings: RemarkableSettings, uploaded: list[tuple[str, Metadata]]):
+        """Add the (location, metadata) of the uploaded books to the calibre metadata of the device"""
+        try:
+            _, booklist = self.device_state(settings)
+            booklist.merge([self.book_from_metadata(m, location) for location, m in uploaded], replace=True)
+            rm_metadata.save(settings, booklist)
+        except:  # noqa: E722
+            LOGGER.warning("Unable to record the uploaded books", exc_info=True)
+
+    def find_uploaded(self, settings: RemarkableSettings, content_hashes: list[str], book_uuids: list[str | None]) -> dict[int, RemarkableBook]:
+        """
+        Return {index: book} of the books of the device that are the calibre book `book_uuids[index]` and whose document
+        has the same content (sha256) as `content_hashes[index]`.
+        Another calibre book with the same content is not a match: its document must not be taken over
+        """
+        tree, booklist = self.device_state(settings)
+        documents = tree.index.id_to_node
+        by_key = {(b.uuid, b.content_hash): b for b in booklist if b.content_hash and b.rm_uuid in documents}
+        found = ((i, by_key.get((u, h))) for i, (u, h) in enumerate(zip(book_uuids, content_hashes)) if u is not None)
+        return {i: book for i, book in found if book is not None}
+
+    @staticmethod
+    def visible_name(name: str):
+        """Name given by xochitl to an uploaded file"""
+        base, ext = posixpath.splitext(name)
+        return base if ext.lower().lstrip(".") in RemarkableUsbDevice.FORMATS else name
+
+    @staticmethod
+    def match_uploads(new_documents: str, names: list[str], completion_order: list[int]) -> dict[int, str]:
+        """
+        Match the uploaded books (indexes of `names`, in completion order) with the new documents on the device
+        (`<uuid>\t<visibleName>` lines) by name, return {index: uuid}
+        """
+
+        uuids_by_name: dict[str, list[str]] = {}
+        for line in new_documents.splitlines():
+            file_uuid, _, visible_name = line.partition("\t")
+            uuids_by_name.setdefault(RemarkableUsbDevice.visible_name(visible_name), []).append(file_uuid)
+
+        matched: dict[int, str] = {}
+        unmatched = []
+        for index in completion_order:
+            candidates = uuids_by_name.get(RemarkableUsbDevice.visible_name(names[index]))
+            if candidates:
+                matched[index] = candidates.pop(0)
+            else:
+                unmatched.append(index)
+
+        remaining = [u for uuids in uuids_by_name.values() for u in uuids]
+        if len(unmatched) == 1 and len(remaining) == 1:
+            matched[unmatched[0]] = remaining[0]
+        elif unmatched:
+            LOGGER.warning(f"Unable to identify the uploads of {[names[i] for i in unmatched]} among {remaining}")
+        return matched
+
     @log_args_kwargs
     def open(self, connected_device, library_uuid):
         pass
@@ -229,7 +449,15 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
     @log_args_kwargs
     def eject(self):
         global device
+        if device is not None:
+            rm_capabilities.invalidate(device)
         device = None
+        settings = self.settings_obj()
+        rm_prefetch.cancel(settings)
+        rm_presence.forget(settings.IP)
+        rm_ssh.close_session(settings)
+        rm_web_interface.close_pool(settings.IP)
+        rm_stats.write_report()
 
     @log_args_kwargs
     def get_device_information(self, end_session=True):
@@ -279,10 +507,7 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
 
     @log_args_kwargs
     def set_progress_reporter(self, report_progress):
-        def dummy_set_progress_reporter(*args, **kwargs):
-            return int(self.progress)
-
-        return dummy_set_progress_reporter
+        self.progress_reporter = report_progress
 
     @log_args_kwargs
     def set_user_blacklisted_devices(self, devices):
@@ -290,6 +515,12 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
 
     @log_args_kwargs
     def shutdown(self):
+        settings = self.settings_obj()
+        rm_prefetch.cancel(settings)
+        rm_restart.scheduler_for(settings).flush()
+        rm_ssh.close_session(settings)
+        rm_web_interface.close_pool(settings.IP)
+        rm_stats.write_report()
         return super().shutdown()
 
     @log_args_kwargs
@@ -323,51 +554,105 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
     @log_args_kwargs
     def sync_booklists(self, booklists: tuple[RemarkableBookList, list, list], end_session=True):
         settings = self.settings_obj()
-        if not rm_ssh.test_connection(settings) or booklists is None:
+        # calibre syncs after each upload/deletion, the report includes them
+        rm_stats.write_report()
+        if not self.has_ssh(settings) or booklists is None:
             # TODO use rm_web_interface if ssh is not available
             return RemarkableBookList(), None, None
 
         booklist0, _, _ = booklists
+        # a restart requested by the upload must not happen while the device state is read and written back
+        with rm_restart.scheduler_for(settings).hold():
+            return self._sync_booklists(settings, booklist0)
+
+    def _sync_booklists(self, settings: RemarkableSettings, booklist0: RemarkableBookList):
+        progress = rm_progress.Progress(self.progress_reporter)
+        progress.start_phase("Reading the calibre metadata on the device", 0.5)
+        tree = None
         try:
-            tree = rm_web_interface.query_tree(settings.IP, "")
-            existing_docs = tree.ls_recursive() + tree.ls_uuid()
-            LOGGER.debug(f"{existing_docs=}")
             LOGGER.info("Attempting to open existing calibre metadata on device")
-            bookslist = self.load_booklist(settings)
+            tree, bookslist = self.device_state(settings)
+            existing_docs = set(tree.ls_recursive() + tree.ls_uuid())
+            LOGGER.debug(f"{existing_docs=}")
             if existing_docs:
-                booklist_on_device = [b for b in bookslist if b.path in existing_docs or b.rm_uuid in existing_docs]
+                booklist_on_device = RemarkableBookList()
+                for b in bookslist:
+                    if b.path in existing_docs or b.rm_uuid in existing_docs:
+                        booklist_on_device.add_book(b)
             else:
                 booklist_on_device = bookslist
             LOGGER.info("got booklist_on_device=%s", booklist_on_device)
+        except (FileNotFoundError, ValueError, TypeError, KeyError):
+            # the calibre metadata is missing or invalid, it starts over from calibre's records
+            LOGGER.warning("Invalid calibre metadata on the device, resetting it", exc_info=True)
+            rm_metadata.reset(settings)
+            booklist_on_device = RemarkableBookList()
         except:  # noqa: E722
+            # the device could not be read (eg. xochitl is restarting): its metadata is left as is until the next sync
             LOGGER.warning("Unable to get metadata", exc_info=True)
-            rm_ssh.init_metadata(settings)
-            booklist_on_device = []
+            progress.finish()
+            return booklist0, None, None
 
-        # TOOD optimize this, maybe somehow hash RemarkableBookList
-        for book in booklist0:
-            if book not in booklist_on_device:
-                booklist_on_device.append(book)
+        # the records of calibre are the most recent (eg. a book that was sent again)
+        booklist_on_device.merge(booklist0, replace=True)
 
-        with tempfile.NamedTemporaryFile("w+t", delete=False) as fp:
-            content = json.dumps([asdict(x) for x in booklist_on_device], indent=1, sort_keys=True, default=str)
-            fp.write(content)
-            fp.flush()
-            rm_ssh.scp(settings, fp.name, settings.CALIBRE_METADATA_PATH)
+        progress.start_phase("Writing the calibre metadata on the device", 1.0)
+        if rm_metadata.save(settings, booklist_on_device) and tree is not None:
+            # the tree is as old as the generation read before it was crawled, only the calibre metadata is new
+            generation = rm_ssh.with_metadata_generation(settings, rm_cache.state_generation(settings))
+            rm_cache.store(settings, generation, tree, booklist_on_device)
 
         LOGGER.info("booklist_on_device=%s", booklist_on_device)
         LOGGER.info("booklist0=%s", booklist0)
         # Make sure our local booklist matches what's on the device too
-        for book in booklist_on_device:
-            if book not in booklist0:
-                LOGGER.info("Adding book %s", book)
-                booklist0.add_book(book)
+        for book in booklist0.merge(booklist_on_device):
+            LOGGER.info("Added book %s", book)
 
+        progress.finish()
         return booklist0, None, None
 
+    def device_state(self, settings: RemarkableSettings):
+        """
+        Return the document tree and the calibre metadata of the device.
+        The first call after the detection takes the snapshot prefetched in the background
+        """
+        prefetched = rm_prefetch.take(settings)
+        if prefetched is not None:
+            return prefetched
+        return self.load_device_state(settings)
+
+    def load_device_state(self, settings: RemarkableSettings, cancelled: threading.Event | None = None):
+        """
+        They come from the local cache while the device generation did not change.
+        Otherwise the tree is crawled while the calibre metadata is read, unless only the documents changed
+        """
+        restart_scheduler = rm_restart.scheduler_for(settings)
+        # xochitl must not restart in the middle of the crawl, and the web interface must be back from the last restart
+        with restart_scheduler.hold():
+            generation = rm_ssh.generation(settings)
+            cached = rm_cache.load(settings, generation)
+            if cached is not None:
+                tree, booklist = cached
+                rm_metadata.remember(settings, booklist)
+                return tree, booklist
+
+            if not restart_scheduler.wait_until_ready():
+                LOGGER.warning("The web interface did not come back after restarting xochitl")
+            # only the documents changed (eg. after an upload): the calibre metadata is not read again
+            booklist = rm_cache.load_booklist(settings, generation)
+            if booklist is not None:
+                rm_metadata.remember(settings, booklist)
+                tree = rm_web_interface.query_tree(settings.IP, "", cancelled=cancelled)
+            else:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    booklist_future = executor.submit(self.load_booklist, settings)
+                    tree = rm_web_interface.query_tree(settings.IP, "", cancelled=cancelled)
+                    booklist = booklist_future.result()
+            rm_cache.store(settings, generation, tree, booklist)
+            return tree, booklist
+
     def load_booklist(self, settings: RemarkableSettings):
-        json_dict = json.loads(rm_ssh.cat(settings, settings.CALIBRE_METADATA_PATH)) or []
-        return list(map(lambda x: RemarkableBook(**x), json_dict))
+        return rm_metadata.load(settings)
 
     @log_args_kwargs
     def prepare_addable_books(self, paths):
@@ -379,27 +664,40 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
         Delete books at paths on device.
         """
         settings = self.settings_obj()
-        has_ssh = rm_ssh.test_connection(settings)
+        has_ssh = self.has_ssh(settings)
         if not has_ssh:
             raise SystemError("This feature requires SSH")
 
         # we assume the path generated in create_upload_path is unique
         LOGGER.debug(f"{paths=}")
-        paths = [b.rm_uuid for b in self.load_booklist(settings) if b.path in paths]
-        rm_ssh.rm(settings, paths=" ".join(f"{u}*" for u in paths))
-
-        rm_ssh.xochitl_restart_after(settings, 5.0)
+        paths = set(paths)
+        _, booklist = self.device_state(settings)
+        to_delete = [b for b in booklist if b.path in paths]
+        if not to_delete:
+            return
+        # a book without rm_uuid has no known document on the device
+        document_uuids = [b.rm_uuid for b in to_delete if b.rm_uuid]
+
+        # the documents are removed and the calibre metadata rewritten in a single ssh invocation,
+        # the documents go first: metadata of missing documents is dropped by sync_booklists
+        booklist.remove_books(to_delete)
+        batch = rm_ssh.SshBatch(settings)
+        rm_index = batch.rm_documents(document_uuids) if document_uuids else None
+        metadata_index = rm_metadata.save_in_batch(settings, booklist, batch)
+        results = batch.run()
+        if metadata_index is not None:
+            rm_metadata.batch_done(settings, results[metadata_index])
+        if rm_index is not None:
+            rm_restart.scheduler_for(settings).request_restart()
+        failed = [r for r in results if not r.ok]
+        if failed:
+            raise SystemError(f"Unable to delete books: {failed}")
 
     @classmethod
     def remove_books_from_metadata(cls, paths, booklists):
         booklist0: RemarkableBookList = booklists[0]
-        to_remove = []
-        for book in booklist0:
-            if book.path in paths:
-                to_remove.append(book)
-
-        for book in to_remove:
-            booklist0.remove_book(book)
+        paths = set(paths)
+        booklist0.remove_books([book for book in booklist0 if book.path in paths])
 
     @log_args_kwargs
     def do_user_config(self, parent=None):
@@ -450,29 +748,33 @@ class RemarkableUsbDevice(DeviceConfig, DevicePlugin):
         booklists: tuple[RemarkableBookList, RemarkableBookList, RemarkableBookList],
     ):
         settings = cls.settings_obj()
-        if not rm_ssh.test_connection(settings):
+        if not cls.has_ssh(settings):
             return
 
         booklist0, _, _ = booklists
         LOGGER.info(f"Adding books to metadata, locations: {locations}, metadata: {metadata}, booklists: {booklists}")
         for i, m in enumerate(metadata):
-            title: str = m.get("title")  # type: ignore
-            authors: list[str] = m.get("authors")  # type: ignore
-            tags: list[str] = m.get("tags")  # type: ignore
-            pubdate = m.get("pubdate").timetuple()
-            size = m.get("size")
-            uuid: str = m.get("uuid")  # type: ignore
-            rm_uuid = m.get(RM_UUID)
-            path = locations[0][i]
-            b = RemarkableBook(
-                title=title,
-                uuid=uuid,
-                rm_uuid=rm_uuid,
-                authors=authors,
-                size=size,
-                datetime=pubdate,
-                tags=tags,
-                path=path,
-            )
-            if b not in booklist0:
-                booklist0.add_book(b, None)
+            # a book sent again replaces its previous record
+            booklist0.merge([cls.book_from_metadata(m, locations[0][i])], replace=True)
+
+    @staticmethod
+    def book_from_metadata(m: Metadata, path: str):
+        title: str = m.get("title")  # type: ignore
+        authors: list[str] = m.get("authors")  # type: ignore
+        tags: list[str] = m.get("tags")  # type: ignore
+        pubdate = m.get("pubdate").timetuple()
+        size = m.get("size")
+        uuid: str = m.get("uuid")  # type: ignore
+        rm_uuid = m.get(RM_UUID)
+        content_hash = m.get(RM_CONTENT_HASH) or ""
+        return RemarkableBook(
+            title=title,
+            uuid=uuid,
+            rm_uuid=rm_uuid,
+            authors=authors,
+            size=size,
+            datetime=pubdate,
+            tags=tags,
+            path=path,
+            content_hash=content_hash,
+        )
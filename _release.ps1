@@ -1,6 +1,6 @@
 mkdir release -Force
 rm .\release\* -Recurse -Force
-cp * release -Exclude img,release,.* -Force -Recurse
+cp * release -Exclude img,release,tests,bench,.* -Force -Recurse
 cd release
 
 Compress-Archive * -CompressionLevel Fastest -DestinationPath remarkable-calibre-usb-device.zip
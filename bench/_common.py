@@ -0,0 +1,189 @@
+"""
+Stand-ins of the device for the benchmarks: the USB web interface served locally, and an `ssh` that runs the commands
+on a local folder standing in for the home of the tablet.
+The plugin is imported as the package `calibre_remarkable_usb_device`, calibre has to be importable.
+"""
+import importlib.util
+import json
+import os
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "calibre_remarkable_usb_device"
+
+
+def load_plugin():
+    if PACKAGE not in sys.modules:
+        spec = importlib.util.spec_from_file_location(PACKAGE, os.path.join(ROOT, "__init__.py"), submodule_search_locations=[ROOT])
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[PACKAGE] = module
+        spec.loader.exec_module(module)
+    return sys.modules[PACKAGE]
+
+
+def synthetic_tree(depth: int, width: int, documents: int) -> dict[str, list[dict]]:
+    """Listings (folder id -> documents) of a tree with `width` folders and `documents` documents per folder, `depth` levels deep"""
+    tree: dict[str, list[dict]] = {}
+    level = [""]
+    for d in range(depth + 1):
+        next_level = []
+        for parent in level:
+            items = [
+                {"ID": f"{parent}/d{j}", "Parent": parent, "Type": "DocumentType", "VissibleName": f"Document {j}", "fileType": "pdf"}
+                for j in range(documents)
+            ]
+            if d < depth:
+                for i in range(width):
+                    items.append({"ID": f"{parent}/c{i}", "Parent": parent, "Type": "CollectionType", "VissibleName": f"Folder {i}"})
+                    next_level.append(f"{parent}/c{i}")
+            tree[parent] = items
+        level = next_level
+    return tree
+
+
+class WebInterface:
+    """
+    The USB web interface serving `tree`, each request takes at least `latency` seconds like on the tablet,
+    and each new connection `connect_latency` seconds more. Uploads are received at `bandwidth` bytes per second (0: unlimited).
+    `on_upload(filename)` is called for each uploaded file (eg. FakeTablet.create_document)
+    """
+
+    def __init__(self, tree: dict[str, list[dict]], latency=0.0, on_upload=None, connect_latency=0.0, bandwidth=0.0):
+        self.tree = tree
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.bandwidth = bandwidth
+        self.on_upload = on_upload
+        self.requests = 0
+        self.connections = 0
+        interface = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # headers and body are written separately, Nagle would hold the body of keep-alive responses until the delayed ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                interface.connections += 1
+                time.sleep(interface.connect_latency)
+
+            def _respond(self, status: int, body: bytes):
+                interface.requests += 1
+                time.sleep(interface.latency)
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._respond(200, json.dumps(interface.tree.get(self.path[len("/documents/") :], [])).encode("utf-8"))
+
+            def do_POST(self):
+                remaining = int(self.headers.get("Content-Length", 0))
+                head = b""
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 64 * 1024))
+                    remaining -= len(chunk)
+                    if interface.bandwidth:
+                        time.sleep(len(chunk) / interface.bandwidth)
+                    head = head or chunk
+                filename = re.search(rb'filename="([^"]*)"', head)
+                if interface.on_upload and filename:
+                    interface.on_upload(filename.group(1).decode("utf-8"))
+                self._respond(201, b"{}")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.ip = f"127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+FAKE_SSH = """#!{python}
+import os, subprocess, sys, threading, time
+bandwidth = float(os.environ.get("REMARKABLE_BENCH_BANDWIDTH") or 0)
+if not bandwidth:
+    sys.exit(subprocess.run(["sh", "-c", sys.argv[-1]]).returncode)
+
+p = subprocess.Popen(["sh", "-c", sys.argv[-1]], stdin=subprocess.PIPE)
+
+def forward():
+    try:
+        while chunk := os.read(0, 64 * 1024):
+            time.sleep(len(chunk) / bandwidth)
+            p.stdin.write(chunk)
+        p.stdin.close()
+    except OSError:
+        pass
+
+# the command may not read its input, it ends whenever the command does
+threading.Thread(target=forward, daemon=True).start()
+os._exit(p.wait())
+"""
+
+
+class FakeTablet:
+    """
+    `ssh` runs the commands locally, in a temporary home holding the xochitl folder. Multiplexing is disabled:
+    each command is a local process, which stands in for a command sent over the master connection.
+    The input of the commands is sent at `bandwidth` bytes per second (0: unlimited)
+    """
+
+    def __init__(self, bandwidth=0.0):
+        self.home = tempfile.mkdtemp(prefix="remarkable-bench-")
+        self.xochitl = os.path.join(self.home, ".local", "share", "remarkable", "xochitl")
+        os.makedirs(self.xochitl)
+        bin_dir = os.path.join(self.home, "bin")
+        os.makedirs(bin_dir)
+        ssh = os.path.join(bin_dir, "ssh")
+        with open(ssh, "w", encoding="utf-8") as fp:
+            fp.write(FAKE_SSH.format(python=sys.executable))
+        os.chmod(ssh, os.stat(ssh).st_mode | stat.S_IEXEC)
+        self._environ = {k: os.environ.get(k) for k in ("HOME", "PATH", "REMARKABLE_BENCH_BANDWIDTH")}
+        os.environ["HOME"] = self.home
+        os.environ["REMARKABLE_BENCH_BANDWIDTH"] = str(bandwidth)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+        load_plugin()
+        from calibre_remarkable_usb_device import rm_ssh
+
+        rm_ssh.ssh_multiplexing = False
+
+    def create_document(self, filename: str):
+        """The document xochitl creates for an upload to the web interface"""
+        from calibre_remarkable_usb_device import rm_ssh_upload
+
+        name, ext = os.path.splitext(filename)
+        document_path = os.path.join(self.xochitl, str(uuid.uuid4()))
+        with open(f"{document_path}.content", "w", encoding="utf-8") as fp:
+            fp.write(rm_ssh_upload.document_content_json(ext.lstrip(".")))
+        with open(f"{document_path}.metadata", "w", encoding="utf-8") as fp:
+            fp.write(rm_ssh_upload.document_metadata_json(name))
+
+    def close(self):
+        for key, value in self._environ.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.home, ignore_errors=True)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
@@ -0,0 +1,55 @@
+"""
+Scaling of the RemarkableBookList operations sync_booklists relies on, at 10k and 50k books:
+building the list, membership, merging the books of calibre, removing a tenth of the books.
+The time per book should stay the same from 10k to 50k books.
+"""
+import gc
+import uuid
+
+from bench._common import load_plugin, timed
+
+SIZES = [10_000, 50_000]
+
+
+def books(n: int):
+    from calibre_remarkable_usb_device.rm_data import RemarkableBook
+
+    return [RemarkableBook(f"Book {i}", str(uuid.uuid4()), str(uuid.uuid4()), path=f"calibre/Author/Book {i}.pdf") for i in range(n)]
+
+
+def run(n: int):
+    from calibre_remarkable_usb_device.rm_data import RemarkableBook, RemarkableBookList
+
+    device_books = books(n)
+    # calibre knows the same books (by uuid) plus a tenth of new ones
+    calibre_books = [RemarkableBook(title=b.title, uuid=b.uuid, path=b.path) for b in device_books] + books(n // 10)
+
+    def build():
+        booklist = RemarkableBookList()
+        for b in device_books:
+            booklist.add_book(b)
+        return booklist
+
+    timings = {}
+    timings["build"], booklist = timed(build)
+    timings["contains"], found = timed(lambda: sum(b in booklist for b in calibre_books))
+    timings["merge"], added = timed(booklist.merge, calibre_books, replace=True)
+    timings["remove 10%"], _ = timed(booklist.remove_books, device_books[::10])
+    assert found == n and len(added) == n // 10 and len(booklist) == n + n // 10 - n // 10
+    return timings
+
+
+def main():
+    load_plugin()
+    # like timeit: the collections triggered by the allocated books would hide the scaling of the operations
+    gc.disable()
+    results = {n: run(n) for n in SIZES}
+    gc.enable()
+    print(f"{'operation':<12}" + "".join(f"{f'{n} books':>22}" for n in SIZES))
+    for operation in results[SIZES[0]]:
+        cells = "".join(f"{results[n][operation] * 1000:>9.1f}ms {results[n][operation] / n * 1e6:>6.2f}µs/book" for n in SIZES)
+        print(f"{operation:<12}{cells}")
+
+
+if __name__ == "__main__":
+    main()
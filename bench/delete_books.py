@@ -0,0 +1,58 @@
+"""
+Deleting DELETED books from a library of LIBRARY documents on the stand-in tablet:
+SshBatch.rm_documents (the folder is listed once) against the former rm of one glob per document,
+which the shell expands by scanning the whole folder for each of them.
+"""
+import os
+import uuid
+
+from bench._common import FakeTablet, load_plugin, timed
+
+LIBRARY = 20_000
+DELETED = 1_000
+# the files and folders xochitl keeps for a document
+SUFFIXES = [".metadata", ".content", ".pagedata", ".pdf", "/", ".thumbnails/"]
+
+
+def create_library(tablet: FakeTablet) -> list[str]:
+    uuids = [str(uuid.uuid4()) for _ in range(LIBRARY)]
+    for u in uuids:
+        for suffix in SUFFIXES:
+            path = os.path.join(tablet.xochitl, u + suffix)
+            if suffix.endswith("/"):
+                os.mkdir(path)
+            else:
+                open(path, "w").close()
+    return uuids
+
+
+def main():
+    load_plugin()
+    from calibre_remarkable_usb_device import rm_ssh
+    from calibre_remarkable_usb_device.rm_data import RemarkableSettings
+
+    settings = RemarkableSettings("tablet", "")
+
+    def batched(uuids):
+        batch = rm_ssh.SshBatch(settings)
+        index = batch.rm_documents(uuids)
+        assert batch.run()[index].ok
+
+    def globbed(uuids):
+        # the command of the former rm_ssh.rm
+        rm_ssh.run(settings, f"cd {rm_ssh.XOCHITL_BASE_FOLDER}; rm {' '.join(f'{u}*' for u in uuids)} -Rf")
+
+    print(f"{DELETED} of {LIBRARY} documents ({len(SUFFIXES)} entries each)")
+    for name, delete in (("one glob per document", globbed), ("SshBatch.rm_documents", batched)):
+        tablet = FakeTablet()
+        try:
+            uuids = create_library(tablet)
+            elapsed, _ = timed(delete, uuids[::LIBRARY // DELETED])
+            assert len(os.listdir(tablet.xochitl)) == (LIBRARY - DELETED) * len(SUFFIXES)
+        finally:
+            tablet.close()
+        print(f"{name:<24} {elapsed:>7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
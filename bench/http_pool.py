@@ -0,0 +1,50 @@
+"""
+Folder listings per second through the ConnectionPool of rm_web_interface, against a new connection per request
+as query_document made them before (urllib.request.urlopen). One client, then QUERY_TREE_MAX_WORKERS clients at once.
+The stand-in web interface answers each request in LATENCY seconds and accepts a connection in CONNECT_LATENCY seconds.
+"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib import request
+
+from bench._common import WebInterface, load_plugin, synthetic_tree, timed
+
+REQUESTS = 400
+LATENCY = 0.001
+CONNECT_LATENCY = 0.005
+
+
+def urlopen_listing(ip, path_id):
+    req = request.Request(f"http://{ip}/documents/{path_id}")
+    req.add_header("Content-Type", "application/json")
+    with request.urlopen(req) as conn:
+        return json.loads(conn.read())
+
+
+def run(interface: WebInterface, query, folders: list[str], workers: int):
+    interface.connections = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        elapsed, _ = timed(lambda: list(executor.map(lambda i: query(interface.ip, folders[i % len(folders)]), range(REQUESTS))))
+    return REQUESTS / elapsed, interface.connections
+
+
+def main():
+    load_plugin()
+    from calibre_remarkable_usb_device import rm_web_interface
+
+    tree = synthetic_tree(1, 20, documents=10)
+    interface = WebInterface(tree, latency=LATENCY, connect_latency=CONNECT_LATENCY)
+    folders = list(tree)
+    try:
+        print(f"{REQUESTS} listings  {'clients':>7} {'requests/s':>10} {'connections':>11}")
+        for workers in (1, rm_web_interface.QUERY_TREE_MAX_WORKERS):
+            for name, query in (("urlopen", urlopen_listing), ("pool", rm_web_interface.query_document)):
+                rate, connections = run(interface, query, folders, workers)
+                rm_web_interface.close_pool(interface.ip)
+                print(f"{name:<15} {workers:>7} {rate:>10.0f} {connections:>11}")
+    finally:
+        interface.close()
+
+
+if __name__ == "__main__":
+    main()
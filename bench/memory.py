@@ -0,0 +1,83 @@
+"""
+Memory retained per tree entry and per book once parsed from JSON, measured with tracemalloc.
+"before" stands for the former classes: plain dataclasses (with a __dict__) and no interned strings for the tree,
+a list of collections per book.
+"""
+import dataclasses
+import gc
+import json
+import tracemalloc
+import uuid
+
+from bench._common import load_plugin, synthetic_tree
+
+FOLDERS = 200
+DOCUMENTS_PER_FOLDER = 100
+BOOKS = 20_000
+
+DocumentBefore = dataclasses.make_dataclass("Document", [("ID", str), ("Parent", str), ("Type", str), ("VissibleName", str), ("fileType", str)])
+ChildNodeBefore = dataclasses.make_dataclass("ChildNode", [("children", list), ("document", DocumentBefore)])
+
+
+def tree_entry_before(d: dict):
+    document = DocumentBefore(d["ID"], d["Parent"], str(d.get("Type")), str(d.get("VissibleName", "")), str(d.get("fileType")))
+    return ChildNodeBefore([], document)
+
+
+def tree_entry_after(d: dict):
+    from calibre_remarkable_usb_device.rm_web_interface import ChildNode, Document
+
+    return ChildNode([], document=Document.parse(d))
+
+
+def book_before(data: str):
+    from calibre_remarkable_usb_device.rm_data import RemarkableBook
+
+    book = RemarkableBook(**json.loads(data))
+    book.device_collections = []
+    return book
+
+
+def book_after(data: str):
+    from calibre_remarkable_usb_device.rm_data import RemarkableBook
+
+    return RemarkableBook(**json.loads(data))
+
+
+def retained(build) -> int:
+    """Bytes still allocated once `build()` returned, the objects it returns are kept alive until measured"""
+    gc.collect()
+    tracemalloc.start()
+    objects = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return current
+
+
+def main():
+    load_plugin()
+    from calibre_remarkable_usb_device.rm_data import RemarkableBook
+
+    # one JSON listing per folder, like the responses of the web interface
+    listings = [json.dumps(items) for items in synthetic_tree(1, FOLDERS, DOCUMENTS_PER_FOLDER).values()]
+    entries = sum(len(json.loads(listing)) for listing in listings)
+    # one JSON record per book, like the metadata file
+    books = [
+        json.dumps(dataclasses.asdict(RemarkableBook(f"Book {i}", str(uuid.uuid4()), str(uuid.uuid4()), ["Author"], path=f"calibre/Author/{i}.pdf")))
+        for i in range(BOOKS)
+    ]
+
+    tree_sizes = [
+        retained(lambda: [build(d) for listing in listings for d in json.loads(listing)]) / entries for build in (tree_entry_before, tree_entry_after)
+    ]
+    book_sizes = [retained(lambda: [build(data) for data in books]) / BOOKS for build in (book_before, book_after)]
+
+    print(f"{'bytes per':<20} {'before':>7} {'after':>7}")
+    print(f"{f'tree entry ({entries})':<20} {tree_sizes[0]:>7.0f} {tree_sizes[1]:>7.0f}")
+    print(f"{f'book ({BOOKS})':<20} {book_sizes[0]:>7.0f} {book_sizes[1]:>7.0f}")
+
+
+if __name__ == "__main__":
+    main()
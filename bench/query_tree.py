@@ -0,0 +1,32 @@
+"""
+Wall time of rm_web_interface.query_tree against the number of folders and the depth of the tree,
+with one request in flight (like the former depth-first crawl) and with the default worker pool.
+The stand-in web interface answers each listing in LATENCY seconds.
+"""
+from bench._common import WebInterface, load_plugin, synthetic_tree, timed
+
+LATENCY = 0.02
+# (depth, folders per folder)
+SHAPES = [(1, 10), (1, 100), (2, 10), (3, 6), (4, 4), (6, 2)]
+
+
+def main():
+    load_plugin()
+    from calibre_remarkable_usb_device import rm_web_interface
+
+    print(f"{'depth':>5} {'width':>5} {'folders':>7} {'1 worker':>9} {f'{rm_web_interface.QUERY_TREE_MAX_WORKERS} workers':>9} {'speedup':>7}")
+    for depth, width in SHAPES:
+        tree = synthetic_tree(depth, width, documents=3)
+        interface = WebInterface(tree, latency=LATENCY)
+        try:
+            sequential, root = timed(rm_web_interface.query_tree, interface.ip, "", max_workers=1)
+            parallel, parallel_root = timed(rm_web_interface.query_tree, interface.ip, "")
+            assert parallel_root.ls_recursive_dict() == root.ls_recursive_dict()
+        finally:
+            interface.close()
+            rm_web_interface.close_pool(interface.ip)
+        print(f"{depth:>5} {width:>5} {len(tree) - 1:>7} {sequential:>8.2f}s {parallel:>8.2f}s {sequential / parallel:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
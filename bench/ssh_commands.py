@@ -0,0 +1,88 @@
+"""
+Number of ssh commands sent during a 50-book upload, for both upload paths, counted by the timing report (rm_stats).
+With multiplexing they all go over a single master connection ("ssh connect" is counted once per master).
+
+With `--device IP`, also measures the latency of a command sent to a real tablet with and without the master connection.
+"""
+import argparse
+import logging
+import os
+import time
+
+from bench._common import FakeTablet, WebInterface, load_plugin
+
+BOOKS = 50
+AUTHORS = 10
+
+
+def count_upload_commands(upload_over_ssh: bool):
+    plugin = load_plugin()
+    from calibre_remarkable_usb_device import rm_restart, rm_stats
+    from calibre_remarkable_usb_device.rm_data import RemarkableSettings
+
+    tablet = FakeTablet()
+    interface = WebInterface({"": []}, on_upload=tablet.create_document)
+    try:
+        with open(os.path.join(tablet.home, ".calibre_remarkable_usb_device.metadata"), "w", encoding="utf-8") as fp:
+            fp.write("[]")
+        books = []
+        for i in range(BOOKS):
+            path = os.path.join(tablet.home, f"book{i}.pdf")
+            with open(path, "wb") as fp:
+                fp.write(os.urandom(64 * 1024))
+            books.append(path)
+
+        settings = RemarkableSettings(interface.ip, "", "2", os.path.join(tablet.home, "timing.json"), upload_over_ssh)
+        device_class = plugin.RemarkableUsbDevice
+        device_class.settings_obj = classmethod(lambda cls: settings)
+        device_class._create_upload_path = lambda self, m, name: f"calibre/Author {int(name[4:-4]) % AUTHORS}/{name}"
+        rm_restart.scheduler_for(settings).start_thread = False
+        rm_stats.configure(settings.TIMING_REPORT)
+        rm_stats.reset()
+
+        device = device_class.__new__(device_class)
+        device.upload_books(books, [f"Book{i}.pdf" for i in range(BOOKS)])
+        report = rm_stats.report()
+    finally:
+        interface.close()
+        tablet.close()
+        rm_stats.configure("")
+    return {operation: stats["count"] for operation, stats in report.items() if operation.startswith(("ssh", "scp"))}
+
+
+def command_latency(ip: str, multiplexing: bool, commands=20):
+    load_plugin()
+    from calibre_remarkable_usb_device import rm_ssh
+    from calibre_remarkable_usb_device.rm_data import RemarkableSettings
+
+    settings = RemarkableSettings(ip, "")
+    rm_ssh.ssh_multiplexing = multiplexing
+    rm_ssh.run(settings, "true")
+    start = time.perf_counter()
+    for _ in range(commands):
+        rm_ssh.run(settings, "true")
+    latency = (time.perf_counter() - start) / commands
+    rm_ssh.close_session(settings)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--device", help="ip of a tablet reachable over ssh")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    for upload_over_ssh in (False, True):
+        counts = count_upload_commands(upload_over_ssh)
+        print(f"{BOOKS} books uploaded {'over ssh' if upload_over_ssh else 'to the web interface'}: {sum(counts.values())} ssh commands")
+        for operation, count in sorted(counts.items()):
+            print(f"  {operation:<24} {count:>5}")
+
+    if args.device:
+        for multiplexing in (False, True):
+            latency = command_latency(args.device, multiplexing)
+            print(f"latency of a command {'over the master connection' if multiplexing else 'with its own connection'}: {latency * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Time of the five ls_* views of a document tree (the calls sync_booklists and the uploads make on each tree),
+from the flat index of Node against the former recursive walks, which rebuilt every path at each level.
+The trees are synthetic: deep and narrow, wide and shallow, and balanced.
+"""
+from bench._common import load_plugin, synthetic_tree, timed
+
+# (name, depth, folders per folder, documents per folder)
+SHAPES = [("deep", 300, 1, 20), ("wide", 1, 3000, 5), ("balanced", 4, 8, 4)]
+VIEWS = ["ls_recursive", "ls_uuid", "ls_dir_recursive", "ls_dir_recursive_dict", "ls_recursive_dict"]
+
+
+def build_tree(listings: dict[str, list[dict]]):
+    from calibre_remarkable_usb_device.rm_web_interface import ChildNode, Document, Node, TypeOfDocument
+
+    def children(folder_id: str):
+        nodes = []
+        for d in listings.get(folder_id, []):
+            document = Document.parse(d)
+            nodes.append(ChildNode(children(document.ID) if document.Type == TypeOfDocument.CollectionType else [], document=document))
+        return nodes
+
+    return Node(children(""))
+
+
+# the views as they were before the index
+
+
+def is_folder(c):
+    return c.document.Type == "CollectionType"
+
+
+def ls_recursive(node):
+    result = []
+    for c in node.children:
+        if is_folder(c):
+            result.extend(f"{c.visible_name}/{path}" for path in ls_recursive(c))
+        else:
+            result.append(c.visible_name)
+    return result
+
+
+def ls_uuid(node):
+    result = []
+    for c in node.children:
+        if is_folder(c):
+            result.extend(ls_uuid(c))
+        else:
+            result.append(c.document.ID)
+    return result
+
+
+def ls_dir_recursive(node):
+    result = []
+    for c in node.children:
+        if is_folder(c):
+            result.append(c.visible_name)
+            result.extend(f"{c.visible_name}/{path}" for path in ls_dir_recursive(c))
+    return result
+
+
+def ls_dir_recursive_dict(node):
+    result = {}
+    for c in node.children:
+        if is_folder(c):
+            result[c.visible_name] = c.document.ID
+            result.update({f"{c.visible_name}/{name}": id for name, id in ls_dir_recursive_dict(c).items()})
+    return result
+
+
+def ls_recursive_dict(node):
+    result = {}
+    for c in node.children:
+        result[c.visible_name] = c.document.ID
+        if is_folder(c):
+            result.update({f"{c.visible_name}/{name}": id for name, id in ls_recursive_dict(c).items()})
+    return result
+
+
+RECURSIVE = [ls_recursive, ls_uuid, ls_dir_recursive, ls_dir_recursive_dict, ls_recursive_dict]
+
+
+def main():
+    load_plugin()
+    print(f"{'tree':<9} {'entries':>7} {'recursive':>10} {'index':>8} {'speedup':>7}")
+    for name, depth, width, documents in SHAPES:
+        tree = build_tree(synthetic_tree(depth, width, documents))
+        recursive, expected = timed(lambda: [view(tree) for view in RECURSIVE])
+        indexed, views = timed(lambda: [getattr(tree, view)() for view in VIEWS])
+        assert [sorted(v) for v in views] == [sorted(v) for v in expected]
+        print(f"{name:<9} {len(tree.index.path_to_id):>7} {recursive * 1000:>8.1f}ms {indexed * 1000:>6.1f}ms {recursive / indexed:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Uploading BOOKS books of BOOK_SIZE bytes to the stand-in tablet, through the web interface (rm_web_interface.upload_files)
+and over ssh (rm_ssh_upload.upload_files), one transfer at a time.
+Then the ssh upload of a book interrupted half-way, which resumes from its staging file, against sending it again.
+Both stand-ins receive each transfer at BANDWIDTH bytes per second, like the USB link of a tablet.
+"""
+import logging
+import os
+
+from bench._common import FakeTablet, WebInterface, load_plugin, timed
+
+BOOKS = 10
+BOOK_SIZE = 4 * 1024 * 1024
+BANDWIDTH = 20e6
+
+
+def documents(tablet: FakeTablet):
+    return sum(name.endswith(".metadata") for name in os.listdir(tablet.xochitl))
+
+
+def main():
+    logging.disable(logging.INFO)
+    load_plugin()
+    from calibre_remarkable_usb_device import rm_ssh_upload, rm_web_interface
+    from calibre_remarkable_usb_device.rm_data import RemarkableSettings
+
+    tablet = FakeTablet(bandwidth=BANDWIDTH)
+    interface = WebInterface({"": []}, on_upload=tablet.create_document, bandwidth=BANDWIDTH)
+    settings = RemarkableSettings(interface.ip, "")
+    try:
+        books = []
+        for i in range(BOOKS):
+            path = os.path.join(tablet.home, f"book{i}.pdf")
+            with open(path, "wb") as fp:
+                fp.write(os.urandom(BOOK_SIZE))
+            books.append(path)
+        uploads = [(path, "", os.path.basename(path)) for path in books]
+
+        print(f"{BOOKS} books of {BOOK_SIZE // 1024 // 1024}MB {'time':>8} {'MB/s':>6}")
+        for name, upload_files in (
+            ("web interface", lambda: rm_web_interface.upload_files(interface.ip, uploads, max_workers=1)),
+            ("ssh", lambda: rm_ssh_upload.upload_files(settings, uploads, max_workers=1)),
+        ):
+            before = documents(tablet)
+            elapsed, results = timed(upload_files)
+            assert all(r.ok for r in results) and documents(tablet) == before + BOOKS
+            print(f"{name:<20} {elapsed:>7.2f}s {BOOKS * BOOK_SIZE / elapsed / 1e6:>6.1f}")
+
+        book = books[0]
+        checksum = rm_ssh_upload.sha256_file(book)
+        staging = os.path.join(tablet.home, os.path.basename(rm_ssh_upload.STAGING_FOLDER), f"{checksum}.part")
+        for name, staged in (("ssh, from scratch", 0), ("ssh, resumed at 50%", BOOK_SIZE // 2)):
+            os.makedirs(os.path.dirname(staging), exist_ok=True)
+            with open(book, "rb") as source, open(staging, "wb") as fp:
+                fp.write(source.read(staged))
+            elapsed, _ = timed(rm_ssh_upload.upload_file, settings, book, "", os.path.basename(book), checksum=checksum)
+            print(f"{name:<20} {elapsed:>7.2f}s")
+    finally:
+        interface.close()
+        rm_web_interface.close_pool(interface.ip)
+        tablet.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,74 @@
+import functools
 import logging
+import reprlib
+import time
+
+from . import rm_stats
+
+LOGGER = logging.getLogger()
+
+
+class _CappedRepr(reprlib.Repr):
+    """reprlib.Repr that also shortens the subclasses of the builtin containers (eg. booklists) instead of formatting them whole"""
+
+    def __init__(self):
+        super().__init__()
+        self.maxlevel = 3
+        self.maxlist = self.maxtuple = self.maxdict = self.maxset = 5
+        self.maxstring = self.maxother = 120
+
+    def repr1(self, x, level):
+        for base in (list, tuple, dict, set, frozenset):
+            if isinstance(x, base) and type(x) is not base:
+                return f"{type(x).__name__}{getattr(self, 'repr_' + base.__name__)(x, level)}"
+        return super().repr1(x, level)
+
+
+_capped_repr = _CappedRepr()
+
+
+def format_call(name: str, args, kwargs):
+    arguments = [_capped_repr.repr(a) for a in args] + [f"{k}={_capped_repr.repr(v)}" for k, v in kwargs.items()]
+    return f"{name}({', '.join(arguments)})"
 
 
 def log_args_kwargs(func):
-    logger = logging.getLogger()
+    """
+    Log each call at DEBUG level with its (shortened) arguments, duration and outcome.
+    The records carry `call`, `duration` (seconds) and `succeeded` attributes, the durations also go to rm_stats.
+    Nothing is formatted nor timed while both DEBUG and rm_stats are disabled
+    """
+    name = func.__qualname__
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        logger.debug(f"__ calibre_remarkable_usb_device call: {func.__name__}, Arguments: {args}, Keyword Arguments: {kwargs}")
-        return func(*args, **kwargs)
+        if not rm_stats.enabled and not LOGGER.isEnabledFor(logging.DEBUG):
+            return func(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            duration = time.perf_counter() - start
+            rm_stats.record(name, duration, succeeded=False)
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug(
+                    "__ calibre_remarkable_usb_device call: %s failed after %.1fms: %r",
+                    format_call(name, args, kwargs),
+                    duration * 1000,
+                    e,
+                    extra={"call": name, "duration": duration, "succeeded": False},
+                )
+            raise
+        duration = time.perf_counter() - start
+        rm_stats.record(name, duration)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(
+                "__ calibre_remarkable_usb_device call: %s took %.1fms",
+                format_call(name, args, kwargs),
+                duration * 1000,
+                extra={"call": name, "duration": duration, "succeeded": True},
+            )
+        return result
 
     return wrapper
@@ -0,0 +1,142 @@
+import dataclasses
+import json
+import logging
+import os
+import threading
+
+from . import rm_ssh
+from .rm_data import RemarkableBook, RemarkableBookList, RemarkableSettings
+from .rm_web_interface import ChildNode, Document, Node
+
+CACHE_VERSION = 1
+
+LOGGER = logging.getLogger()
+
+# generation at which the last device state of each ip was read, see state_generation
+_lock = threading.Lock()
+_state_generations: dict[str, str | None] = {}
+
+
+def cache_path(settings: RemarkableSettings):
+    from calibre.constants import cache_dir  # type: ignore
+
+    return os.path.join(cache_dir(), "remarkable-calibre-usb-device", f"{settings.IP}.json")
+
+
+def _dump_tree(tree: Node):
+    result = []
+    level: list[tuple[str, Node]] = [("", tree)]
+    while level:
+        next_level = []
+        for parent_id, node in level:
+            for c in node.children:
+                result.append({"parent": parent_id, "document": dataclasses.asdict(c.document)})
+                next_level.append((c.document.ID, c))
+        level = next_level
+    return result
+
+
+def _load_tree(documents: list[dict]):
+    root = Node.new_empty()
+    id_to_node: dict[str, Node] = {"": root}
+    for d in documents:
+        node = ChildNode([], document=Document.parse(d["document"]))
+        id_to_node[d["parent"]].children.append(node)
+        id_to_node[node.document.ID] = node
+    return root
+
+
+def _read(settings: RemarkableSettings, matches):
+    """The cache of the device if `matches(its generation)`, else None"""
+    try:
+        with open(cache_path(settings), "r", encoding="utf-8") as fp:
+            cached = json.load(fp)
+        if cached["version"] != CACHE_VERSION or not matches(cached["generation"]):
+            return None
+        return cached
+    except FileNotFoundError:
+        return None
+    except:  # noqa: E722
+        LOGGER.warning("Ignoring invalid device cache", exc_info=True)
+        return None
+
+
+def _load_booklist(books: list[dict]):
+    booklist = RemarkableBookList()
+    for book in books:
+        booklist.add_book(RemarkableBook(**book))
+    return booklist
+
+
+def load(settings: RemarkableSettings, generation: str | None):
+    """
+    Return the cached (tree, calibre metadata) of the device if it was stored for this generation, else None
+    """
+    if generation is None:
+        return None
+    cached = _read(settings, lambda cached_generation: cached_generation == generation)
+    if cached is None:
+        return None
+    try:
+        booklist = _load_booklist(cached["books"])
+        tree = _load_tree(cached["documents"])
+    except:  # noqa: E722
+        LOGGER.warning("Ignoring invalid device cache", exc_info=True)
+        return None
+    LOGGER.debug(f"device state loaded from cache, {generation=}")
+    remember_generation(settings, generation)
+    return tree, booklist
+
+
+def load_booklist(settings: RemarkableSettings, generation: str | None):
+    """
+    Return the cached calibre metadata of the device if it did not change since it was stored, else None.
+    Only the documents changed (eg. after an upload): the tree has to be crawled again, not the metadata read again
+    """
+    parts = rm_ssh.split_generation(generation)
+    if parts is None:
+        return None
+    cached = _read(settings, lambda cached_generation: (rm_ssh.split_generation(cached_generation) or (None, None))[1] == parts[1])
+    if cached is None:
+        return None
+    try:
+        booklist = _load_booklist(cached["books"])
+    except:  # noqa: E722
+        LOGGER.warning("Ignoring invalid device cache", exc_info=True)
+        return None
+    LOGGER.debug(f"calibre metadata loaded from cache, {generation=}")
+    return booklist
+
+
+def remember_generation(settings: RemarkableSettings, generation: str | None):
+    with _lock:
+        _state_generations[settings.IP] = generation
+
+
+def state_generation(settings: RemarkableSettings):
+    """The generation read before the last device state was loaded (from the cache or the device), None if unknown"""
+    with _lock:
+        return _state_generations.get(settings.IP)
+
+
+def store(settings: RemarkableSettings, generation: str | None, tree: Node, booklist):
+    remember_generation(settings, generation)
+    if generation is None:
+        return
+    path = cache_path(settings)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as fp:
+            json.dump(
+                {
+                    "version": CACHE_VERSION,
+                    "generation": generation,
+                    "documents": _dump_tree(tree),
+                    "books": [dataclasses.asdict(b) for b in booklist],
+                },
+                fp,
+                default=str,
+            )
+        os.replace(f"{path}.tmp", path)
+    except:  # noqa: E722
+        LOGGER.warning("Unable to write device cache", exc_info=True)
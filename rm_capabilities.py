@@ -0,0 +1,55 @@
+import logging
+import threading
+import time
+
+from . import rm_ssh
+from .rm_data import DeviceCapabilities, RemarkableDeviceDescription, RemarkableSettings
+
+CAPABILITIES_TTL = 60.0
+
+# reentrant: a failing probe invalidates the cache through rm_ssh.connection_error_listeners
+_lock = threading.RLock()
+_cache: dict[RemarkableDeviceDescription, DeviceCapabilities] = {}
+
+
+def get_capabilities(device: RemarkableDeviceDescription, settings: RemarkableSettings, ttl=CAPABILITIES_TTL) -> DeviceCapabilities:
+    """
+    Return the cached capabilities of the device, probing SSH again once they are older than `ttl` seconds
+    """
+    with _lock:
+        capabilities = _cache.get(device)
+        if capabilities is not None and time.monotonic() - capabilities.probed_at < ttl:
+            return capabilities
+
+        has_ssh, is_writable = rm_ssh.probe_connection(settings)
+        has_web_interface = capabilities.has_web_interface if capabilities is not None else True
+        capabilities = DeviceCapabilities(has_ssh, is_writable, has_web_interface, time.monotonic())
+        logging.getLogger().debug(f"probed {device=}: {capabilities=}")
+        _cache[device] = capabilities
+        return capabilities
+
+
+def set_web_interface_status(device: RemarkableDeviceDescription, has_web_interface: bool):
+    with _lock:
+        _cache.setdefault(device, DeviceCapabilities()).has_web_interface = has_web_interface
+
+
+def web_interface_status(device: RemarkableDeviceDescription) -> bool:
+    """Whether the web interface answered the last time it was checked, True if it never was"""
+    with _lock:
+        capabilities = _cache.get(device)
+        return capabilities is None or capabilities.has_web_interface
+
+
+def invalidate(device: RemarkableDeviceDescription):
+    with _lock:
+        _cache.pop(device, None)
+
+
+def invalidate_ip(settings: RemarkableSettings):
+    with _lock:
+        for device in [d for d in _cache if d.ip == settings.IP]:
+            del _cache[device]
+
+
+rm_ssh.connection_error_listeners.append(invalidate_ip)
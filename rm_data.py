@@ -1,10 +1,11 @@
 from __future__ import annotations
 
+import itertools
 import json
 import random
 import time
 from dataclasses import asdict, dataclass, field
-from typing import List
+from typing import Sequence
 
 from calibre.devices.interface import BookList  # type: ignore
 
@@ -15,8 +16,18 @@ from . import rm_web_interface as rm_web_interface
 class RemarkableSettings:
     IP: str
     SSH_PASSWORD: str
+    PARALLEL_UPLOADS: str = "2"
+    TIMING_REPORT: str = ""
+    UPLOAD_OVER_SSH: bool = False
 
     CALIBRE_METADATA_PATH = "~/.calibre_remarkable_usb_device.metadata"
+    CALIBRE_METADATA_JOURNAL_PATH = "~/.calibre_remarkable_usb_device.metadata.journal"
+
+    def parallel_uploads(self) -> int:
+        try:
+            return max(1, int(self.PARALLEL_UPLOADS))
+        except ValueError:
+            return 1
 
 
 @dataclass
@@ -28,10 +39,35 @@ class RemarkableDeviceDescription:
     def __str__(self) -> str:
         return f"Remarkable on http://{self.ip}, rid={self.random_id}"
 
+    def __eq__(self, other) -> bool:
+        return isinstance(other, RemarkableDeviceDescription) and (self.ip, self.random_id) == (other.ip, other.random_id)
+
+    def __hash__(self) -> int:
+        return hash((self.ip, self.random_id))
+
+
+@dataclass
+class DeviceCapabilities:
+    has_ssh: bool = False
+    is_writable: bool = False
+    has_web_interface: bool = False
+    # never probed: stale whatever the clock
+    probed_at: float = float("-inf")
+
 
 class RemarkableBookList(BookList):
+    """
+    Books are indexed on both `uuid` and `rm_uuid`, which gives O(1) lookups with the same matching rules as RemarkableBook.__eq__
+    """
+
     def __init__(self, oncard="", prefix="", settings=""):
         super().__init__(oncard, prefix, settings)
+        # key -> {id(book): book}, in insertion order
+        self._by_uuid: dict[str, dict[int, RemarkableBook]] = {}
+        self._by_rm_uuid: dict[str, dict[int, RemarkableBook]] = {}
+        # id(book) -> insertion number, the earliest inserted book is also the first one in the list
+        self._insertion: dict[int, int] = {}
+        self._counter = itertools.count()
 
     def supports_collections(self):
         return False
@@ -42,6 +78,69 @@ class RemarkableBookList(BookList):
     def remove_book(self, book):
         self.remove(book)
 
+    def __contains__(self, book):
+        return book.rm_uuid in self._by_rm_uuid or book.uuid in self._by_uuid
+
+    def find(self, book):
+        """Return the first book equal to `book`, or None"""
+        candidates = [
+            next(iter(index[key].values())) for index, key in ((self._by_rm_uuid, book.rm_uuid), (self._by_uuid, book.uuid)) if key in index
+        ]
+        return min(candidates, key=lambda b: self._insertion[id(b)], default=None)
+
+    def append(self, book):
+        super().append(book)
+        self._insertion[id(book)] = next(self._counter)
+        self._by_uuid.setdefault(book.uuid, {})[id(book)] = book
+        self._by_rm_uuid.setdefault(book.rm_uuid, {})[id(book)] = book
+
+    def _unindex(self, book):
+        del self._insertion[id(book)]
+        for index, key in ((self._by_uuid, book.uuid), (self._by_rm_uuid, book.rm_uuid)):
+            books = index[key]
+            del books[id(book)]
+            if not books:
+                del index[key]
+
+    def remove(self, book):
+        found = self.find(book)
+        if found is None:
+            raise ValueError(f"{book} not in list")
+        self._unindex(found)
+        del self[next(i for i, b in enumerate(self) if b is found)]
+
+    def remove_books(self, books):
+        """Remove the first match of each of `books` in a single pass over the list"""
+        to_remove = set()
+        for book in books:
+            found = self.find(book)
+            if found is not None:
+                self._unindex(found)
+                to_remove.add(id(found))
+        self[:] = [b for b in self if id(b) not in to_remove]
+
+    def merge(self, books, replace=False):
+        """
+        Add the books that are not in the list yet, return them.
+        With `replace`, a book of the list that is equal to one of `books` is replaced by the first of them,
+        the others are dropped as they would be without `replace`
+        """
+        added = []
+        # id(book of the list) -> (book of the list, its replacement)
+        replaced: dict[int, tuple[RemarkableBook, RemarkableBook]] = {}
+        for book in books:
+            found = self.find(book)
+            if found is None:
+                self.add_book(book)
+                added.append(book)
+            elif replace and found is not book and id(found) not in replaced:
+                replaced[id(found)] = (found, book)
+        if replaced:
+            self.remove_books([found for found, _ in replaced.values()])
+            for _, book in replaced.values():
+                self.add_book(book)
+        return added
+
     def get_collections(self, collection_attributes):
         return self
 
@@ -59,6 +158,10 @@ class RemarkableBookList(BookList):
 
 @dataclass()
 class RemarkableBook:
+    """
+    Not slotted: calibre sets its own attributes (eg. `in_library`) on the books of the device
+    """
+
     title: str
     uuid: str
     rm_uuid: str = ""
@@ -69,8 +172,11 @@ class RemarkableBook:
     thumbnail = None
     tags: list[str] = field(default_factory=list)
     path: str = "/"
+    # sha256 of the uploaded file
+    content_hash: str = ""
 
-    device_collections: List = field(default_factory=list)
+    # calibre only replaces the collections of a book, the empty ones can all be the same
+    device_collections: Sequence = ()
 
     def __eq__(self, other: RemarkableBook):  # type: ignore
         return self.rm_uuid == other.rm_uuid or self.uuid == other.uuid
@@ -78,3 +184,5 @@ class RemarkableBook:
     def __post_init__(self):
         # When RemarkableBook is created from a json blob the argument is a n array and must be converted properly
         self.datetime = time.struct_time(self.datetime)
+        if not self.device_collections:
+            self.device_collections = ()
@@ -0,0 +1,203 @@
+"""
+Calibre metadata stored on the device.
+
+The metadata is a JSON snapshot (CALIBRE_METADATA_PATH) followed by an append-only journal (CALIBRE_METADATA_JOURNAL_PATH),
+one record per line: `<crc32> {"op": "put"|"del", "key": ..., "book": ...}`.
+Saving only appends the records that changed since the last load/save, the journal is compacted into the snapshot
+once it holds more records than half the snapshot, or when a partially written record is found.
+"""
+import hashlib
+import json
+import logging
+import threading
+import zlib
+from dataclasses import asdict, dataclass, field
+
+from . import rm_ssh
+from .rm_data import RemarkableBook, RemarkableBookList, RemarkableSettings
+
+COMPACTION_MIN_RECORDS = 100
+
+LOGGER = logging.getLogger()
+
+
+@dataclass
+class _StoreState:
+    # key -> serialized book, as it is on the device
+    records: dict[str, str] = field(default_factory=dict)
+    journal_records: int = 0
+    needs_compaction: bool = False
+
+    @property
+    def digest(self):
+        return _digest(self.records)
+
+
+_lock = threading.Lock()
+_states: dict[str, _StoreState] = {}
+# state after the write queued by save_in_batch
+_pending: dict[str, _StoreState] = {}
+
+
+def _key(book: RemarkableBook):
+    return str(book.uuid)
+
+
+def _serialize(book: RemarkableBook):
+    return json.dumps(asdict(book), sort_keys=True, default=str)
+
+
+def _digest(records: dict[str, str]):
+    h = hashlib.sha1()
+    for key in sorted(records):
+        h.update(key.encode("utf-8"))
+        h.update(records[key].encode("utf-8"))
+    return h.hexdigest()
+
+
+def _journal_line(record: dict):
+    payload = json.dumps(record, sort_keys=True, default=str)
+    return f"{zlib.crc32(payload.encode('utf-8')):08x} {payload}\n"
+
+
+def _parse_journal_line(line: str):
+    """Return the record, or None if the line was not completely written"""
+    crc, _, payload = line.partition(" ")
+    try:
+        if int(crc, 16) != zlib.crc32(payload.encode("utf-8")):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def _replay(snapshot: list[dict], journal: str):
+    state = _StoreState()
+    for book in snapshot:
+        state.records[str(book["uuid"])] = _serialize(RemarkableBook(**book))
+    for line in journal.splitlines():
+        if not line.strip():
+            continue
+        record = _parse_journal_line(line)
+        if record is None:
+            LOGGER.warning(f"Ignoring the partially written end of {RemarkableSettings.CALIBRE_METADATA_JOURNAL_PATH}")
+            state.needs_compaction = True
+            break
+        state.journal_records += 1
+        if record["op"] == "put":
+            state.records[record["key"]] = _serialize(RemarkableBook(**record["book"]))
+        else:
+            state.records.pop(record["key"], None)
+    return state
+
+
+def load(settings: RemarkableSettings) -> RemarkableBookList:
+    """
+    Read the snapshot and the journal in a single ssh invocation
+    """
+    batch = rm_ssh.SshBatch(settings)
+    snapshot_index = batch.add(f"cat {settings.CALIBRE_METADATA_PATH}")
+    journal_index = batch.add(f"cat {settings.CALIBRE_METADATA_JOURNAL_PATH} 2>/dev/null; true")
+    results = batch.run()
+    if results[snapshot_index].returncode == 255:
+        raise ConnectionError(f"Unable to reach the device to read {settings.CALIBRE_METADATA_PATH}")
+    if not results[snapshot_index].ok:
+        raise FileNotFoundError(f"Unable to read {settings.CALIBRE_METADATA_PATH}: {results[snapshot_index].output}")
+
+    state = _replay(json.loads(results[snapshot_index].output) or [], results[journal_index].output)
+    with _lock:
+        _states[settings.IP] = state
+
+    booklist = RemarkableBookList()
+    for book in state.records.values():
+        booklist.add_book(RemarkableBook(**json.loads(book)))
+    return booklist
+
+
+def remember(settings: RemarkableSettings, books):
+    """
+    Record that the device's metadata is `books` (loaded from somewhere else than `load`)
+    """
+    records = {_key(b): _serialize(b) for b in books}
+    with _lock:
+        state = _states.get(settings.IP)
+        if state is None or state.digest != _digest(records):
+            _states[settings.IP] = _StoreState(records)
+
+
+def _plan_save(settings: RemarkableSettings, records: dict[str, str]):
+    """
+    Return (path, content, append, state after the write) to write `records`, None if the device is up to date
+    """
+    state = _states.get(settings.IP)
+    if state is not None and not state.needs_compaction and state.digest == _digest(records):
+        return None
+
+    if state is not None and not state.needs_compaction:
+        lines = [_journal_line({"op": "del", "key": k}) for k in state.records.keys() - records.keys()]
+        lines += [_journal_line({"op": "put", "key": k, "book": json.loads(v)}) for k, v in records.items() if state.records.get(k) != v]
+        if state.journal_records + len(lines) <= max(COMPACTION_MIN_RECORDS, len(records) // 2):
+            # the leading newline guarantees records never get appended to an unterminated line
+            return settings.CALIBRE_METADATA_JOURNAL_PATH, "\n" + "".join(lines), True, _StoreState(records, state.journal_records + len(lines))
+
+    # replace the snapshot and drop the journal
+    content = json.dumps([json.loads(v) for v in records.values()], indent=1, sort_keys=True, default=str)
+    return settings.CALIBRE_METADATA_PATH, content, False, _StoreState(records)
+
+
+def save(settings: RemarkableSettings, books):
+    """
+    Write `books` to the device, only sending what changed since the last load/save.
+    Return False if nothing had to be written
+    """
+    records = {_key(b): _serialize(b) for b in books}
+    with _lock:
+        plan = _plan_save(settings, records)
+        if plan is None:
+            LOGGER.debug("calibre metadata unchanged, skipping write")
+            return False
+        path, content, append, state = plan
+        _write(settings, path, content, append=append)
+        _states[settings.IP] = state
+        return True
+
+
+def save_in_batch(settings: RemarkableSettings, books, batch: rm_ssh.SshBatch) -> int | None:
+    """
+    Like `save`, but the write is queued in `batch` so that it runs in the same ssh invocation as the other commands.
+    Return the index of its result, None if nothing has to be written. The result must be passed to `batch_done`
+    """
+    records = {_key(b): _serialize(b) for b in books}
+    with _lock:
+        plan = _plan_save(settings, records)
+        if plan is None:
+            return None
+        path, content, append, state = plan
+        _pending[settings.IP] = state
+        return batch.write(path, content, append=append, then=None if append else f"rm -f {settings.CALIBRE_METADATA_JOURNAL_PATH}")
+
+
+def batch_done(settings: RemarkableSettings, result: rm_ssh.SshCommandResult):
+    with _lock:
+        state = _pending.pop(settings.IP, None)
+        if result.ok and state is not None:
+            _states[settings.IP] = state
+        else:
+            # the device is in an unknown state, the next save rewrites everything
+            _states.pop(settings.IP, None)
+
+
+def _write(settings: RemarkableSettings, path: str, content: str, append=False):
+    try:
+        rm_ssh.write(settings, path, content, append=append, then=None if append else f"rm -f {settings.CALIBRE_METADATA_JOURNAL_PATH}")
+    except:  # noqa: E722
+        # the device is in an unknown state, the next save rewrites everything
+        _states.pop(settings.IP, None)
+        raise
+
+
+def reset(settings: RemarkableSettings):
+    with _lock:
+        _states.pop(settings.IP, None)
+    return rm_ssh.init_metadata(settings)
+
@@ -0,0 +1,84 @@
+"""
+Warm-up of the device state, started in the background as soon as the device is detected.
+
+calibre calls books() right after the detection: meanwhile the capabilities are probed, then the document tree is crawled
+while the calibre metadata is read. books() takes the snapshot, waiting for it if it is not ready yet.
+A snapshot is only handed out once, the later calls load the device state themselves.
+"""
+import logging
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+
+from . import rm_capabilities
+from .rm_data import RemarkableDeviceDescription, RemarkableSettings
+
+# seconds books() waits for the snapshot before loading the device state itself
+TAKE_TIMEOUT = 300.0
+
+LOGGER = logging.getLogger()
+
+
+class Prefetch:
+    def __init__(self, device: RemarkableDeviceDescription, settings: RemarkableSettings, load_state):
+        """`load_state(settings, cancelled)` returns the (tree, booklist) of the device, it should stop once `cancelled` is set"""
+        self.device = device
+        self.cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="remarkable-prefetch")
+        self.state: Future = executor.submit(self._load, settings, load_state)
+        executor.shutdown(wait=False)
+
+    def _load(self, settings: RemarkableSettings, load_state):
+        # the device state needs ssh, and the probe opens the ssh session that load_state reuses
+        capabilities = rm_capabilities.get_capabilities(self.device, settings)
+        if not (capabilities.has_ssh and capabilities.is_writable) or self.cancelled.is_set():
+            return None
+        return load_state(settings, self.cancelled)
+
+    def cancel(self):
+        self.cancelled.set()
+        self.state.cancel()
+
+    def result(self, timeout=TAKE_TIMEOUT):
+        """The (tree, booklist) snapshot, or None if it could not be fetched"""
+        try:
+            return self.state.result(timeout)
+        except CancelledError:
+            return None
+        except:  # noqa: E722
+            LOGGER.warning("Device state prefetch failed", exc_info=True)
+            return None
+
+
+_lock = threading.Lock()
+_prefetches: dict[str, Prefetch] = {}
+
+
+def start(device: RemarkableDeviceDescription, settings: RemarkableSettings, load_state):
+    """Start fetching the state of the newly detected `device`, replacing the previous warm-up of the same ip"""
+    prefetch = Prefetch(device, settings, load_state)
+    with _lock:
+        previous = _prefetches.get(settings.IP)
+        _prefetches[settings.IP] = prefetch
+    if previous is not None:
+        previous.cancel()
+    LOGGER.debug(f"prefetching the state of {device=}")
+    return prefetch
+
+
+def take(settings: RemarkableSettings, timeout=TAKE_TIMEOUT):
+    """
+    Return the prefetched (tree, booklist) of the device, waiting for it if it is still being fetched.
+    None if there is no warm-up pending or it failed, the caller then loads the state itself
+    """
+    with _lock:
+        prefetch = _prefetches.pop(settings.IP, None)
+    if prefetch is None:
+        return None
+    return prefetch.result(timeout)
+
+
+def cancel(settings: RemarkableSettings):
+    with _lock:
+        prefetch = _prefetches.pop(settings.IP, None)
+    if prefetch is not None:
+        prefetch.cancel()
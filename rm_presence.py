@@ -0,0 +1,74 @@
+"""
+Cheap detection of the device for calibre's polling: a TCP connect to the web interface instead of a listing.
+The result is kept for a few seconds while the device is present, and the probes back off exponentially while it is absent.
+"""
+import logging
+import socket
+import threading
+import time
+from dataclasses import dataclass
+
+PROBE_TIMEOUT = 0.5
+# seconds before checking again that a present device is still there
+PRESENT_RECHECK_INTERVAL = 3.0
+ABSENT_BACKOFF_MIN = 1.0
+ABSENT_BACKOFF_MAX = 30.0
+
+LOGGER = logging.getLogger()
+
+
+@dataclass
+class DevicePresence:
+    present: bool = False
+    next_probe_at: float = 0.0
+    backoff: float = ABSENT_BACKOFF_MIN
+
+
+_lock = threading.Lock()
+_presences: dict[str, DevicePresence] = {}
+
+
+def _tcp_probe(ip: str, timeout=PROBE_TIMEOUT):
+    host, _, port = ip.partition(":")
+    try:
+        with socket.create_connection((host, int(port or 80)), timeout=timeout):
+            return True
+    except (OSError, ValueError):
+        return False
+
+
+def probe(ip: str, clock=time.monotonic, tcp_probe=_tcp_probe) -> tuple[bool, bool]:
+    """
+    Return (the device is present, it just appeared). The device is only probed when the last result is due
+    """
+    with _lock:
+        presence = _presences.setdefault(ip, DevicePresence())
+        now = clock()
+        if now < presence.next_probe_at:
+            return presence.present, False
+
+        was_present = presence.present
+        presence.present = tcp_probe(ip)
+        if presence.present:
+            presence.backoff = ABSENT_BACKOFF_MIN
+            presence.next_probe_at = now + PRESENT_RECHECK_INTERVAL
+        else:
+            presence.next_probe_at = now + presence.backoff
+            presence.backoff = min(presence.backoff * 2, ABSENT_BACKOFF_MAX)
+        if presence.present != was_present:
+            LOGGER.debug(f"{ip} is {'present' if presence.present else 'absent'}, next probe in {presence.next_probe_at - now}s")
+        return presence.present, presence.present and not was_present
+
+
+def mark_absent(ip: str, clock=time.monotonic):
+    """The device did not answer (eg. its web interface is disabled), probe it again after the backoff"""
+    with _lock:
+        presence = _presences.setdefault(ip, DevicePresence())
+        presence.present = False
+        presence.next_probe_at = clock() + presence.backoff
+        presence.backoff = min(presence.backoff * 2, ABSENT_BACKOFF_MAX)
+
+
+def forget(ip: str):
+    with _lock:
+        _presences.pop(ip, None)
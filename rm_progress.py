@@ -0,0 +1,161 @@
+"""
+Progress of the device operations, reported to calibre by bytes instead of by whole books.
+
+An operation is a sequence of phases, each covering a share of the progress bar (eg. preparing the folders,
+then transferring the books). Within a phase the progress follows the bytes done out of the bytes expected.
+The throughput and the estimated time left are computed over the last seconds, so a stalled transfer shows as such.
+The reports to calibre are throttled, phase changes and the end of the operation are always reported.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+# seconds between two reports to calibre
+REPORT_INTERVAL = 0.5
+# seconds the throughput is computed over
+RATE_WINDOW = 5.0
+
+LOGGER = logging.getLogger()
+
+
+def format_duration(seconds: float):
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class Progress:
+    """
+    Thread-safe progress of one operation, to use as a context manager.
+    `report(fraction, message)` is calibre's progress reporter, called with a fraction between 0 and 1.
+    While in the context, the progress is also reported periodically when nothing moves
+    """
+
+    def __init__(self, report=None, clock=time.monotonic, interval=REPORT_INTERVAL):
+        self._report = report
+        self._clock = clock
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._last_report_at = float("-inf")
+        self._stopped = threading.Event()
+        self.message = ""
+        self._start = 0.0
+        self._end = 0.0
+        self._phase_started_at = clock()
+        # bytes done and expected per item (eg. per book) of the current phase
+        self._done: dict = {}
+        self._totals: dict = {}
+        # (time, bytes processed since the start of the phase), an item that starts over is not counted again
+        self._processed = 0
+        self._samples: deque[tuple[float, int]] = deque([(self._phase_started_at, 0)])
+
+    def __enter__(self):
+        if self._report is not None:
+            threading.Thread(target=self._heartbeat, name="remarkable-progress", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self._interval):
+            self._push()
+
+    def start_phase(self, message: str, end: float, totals: dict | None = None):
+        """
+        Start the next phase, from the end of the previous one to `end`, following the bytes of `totals` (bytes expected per item).
+        A phase without totals stays at its start until the next one
+        """
+        with self._lock:
+            self._start = self._end
+            self._end = max(self._start, end)
+            self.message = message
+            self._done = {}
+            self._totals = dict(totals or {})
+            self._processed = 0
+            self._phase_started_at = self._clock()
+            self._samples = deque([(self._phase_started_at, 0)])
+        self._push(force=True)
+
+    def update(self, item, done: int, total: int | None = None):
+        """`done` bytes of `item` were processed, out of `total` if it changed"""
+        with self._lock:
+            if total is not None:
+                self._totals[item] = total
+            self._processed += max(0, done - self._done.get(item, 0))
+            self._done[item] = done
+            self._samples.append((self._clock(), self._processed))
+        self._push()
+
+    def finish(self, message: str | None = None):
+        with self._lock:
+            self._start = self._end = 1.0
+            self._totals = {}
+            if message is not None:
+                self.message = message
+        self._push(force=True)
+
+    def _fraction(self):
+        total = sum(self._totals.values())
+        if total <= 0:
+            return self._start
+        done = sum(min(self._done.get(item, 0), t) for item, t in self._totals.items())
+        return self._start + (self._end - self._start) * done / total
+
+    def _rate(self, now: float):
+        # the samples older than the window are dropped, except the last of them that is the baseline
+        while len(self._samples) > 1 and self._samples[1][0] <= now - RATE_WINDOW:
+            self._samples.popleft()
+        first_at, first_processed = self._samples[0]
+        return (self._processed - first_processed) / (now - first_at) if now > first_at else 0.0
+
+    @property
+    def fraction(self) -> float:
+        with self._lock:
+            return self._fraction()
+
+    @property
+    def rate(self) -> float:
+        """Throughput of the current phase over the last seconds, in bytes per second"""
+        with self._lock:
+            return self._rate(self._clock())
+
+    @property
+    def eta(self) -> float | None:
+        """Seconds left in the current phase, None while the throughput is 0"""
+        with self._lock:
+            rate = self._rate(self._clock())
+            remaining = sum(max(0, t - self._done.get(item, 0)) for item, t in self._totals.items())
+        return remaining / rate if rate > 0 else None
+
+    def describe(self) -> str:
+        """The message of the phase, with the bytes done, the throughput and the time left during a transfer"""
+        with self._lock:
+            now = self._clock()
+            message = self.message
+            total = sum(self._totals.values())
+            done = sum(min(self._done.get(item, 0), t) for item, t in self._totals.items())
+            rate = self._rate(now)
+            waited = now - self._phase_started_at
+        if total <= 0 or done >= total:
+            return message
+        if rate > 0:
+            left = f"{format_duration((total - done) / rate)} left"
+        else:
+            left = "stalled" if waited > RATE_WINDOW else "starting"
+        return f"{message} ({done / 1e6:.1f}/{total / 1e6:.1f} MB, {rate / 1e6:.1f} MB/s, {left})"
+
+    def _push(self, force=False):
+        if self._report is None:
+            return
+        now = self._clock()
+        with self._lock:
+            if not force and now - self._last_report_at < self._interval:
+                return
+            self._last_report_at = now
+        fraction, message = self.fraction, self.describe()
+        try:
+            self._report(fraction, message)
+        except:  # noqa: E722
+            LOGGER.warning("Unable to report the progress", exc_info=True)
@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from . import rm_ssh, rm_web_interface
+from .rm_data import RemarkableSettings
+
+RESTART_DELAY = 5.0
+READY_TIMEOUT = 60.0
+READY_POLL_INTERVAL = 1.0
+
+LOGGER = logging.getLogger()
+
+
+class RestartScheduler:
+    """
+    Coalesce the xochitl restarts requested for a device: a single restart happens `delay` seconds after the last request,
+    and never while a transfer holds it.
+    `clock`, `sleep`, `restart` and `check_connection` can be replaced (eg. by a fake clock), `start_thread=False` leaves
+    the restarts to explicit `poll()` calls.
+    """
+
+    def __init__(
+        self,
+        settings: RemarkableSettings,
+        delay=RESTART_DELAY,
+        clock=time.monotonic,
+        sleep=time.sleep,
+        restart=rm_ssh.xochitl_restart,
+        check_connection=rm_web_interface.check_connection,
+        start_thread=True,
+    ):
+        self.settings = settings
+        self.delay = delay
+        self.clock = clock
+        self.sleep = sleep
+        self.restart = restart
+        self.check_connection = check_connection
+        self.start_thread = start_thread
+
+        self._condition = threading.Condition()
+        self._pending = False
+        self._deadline = 0.0
+        self._holds = 0
+        # the restart command is running: the web interface that answers may still be the one being stopped
+        self._restarting = False
+        # xochitl was restarted and the web interface has not been seen up since
+        self._restarted = False
+        self._thread: threading.Thread | None = None
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def request_restart(self, delay: float | None = None):
+        with self._condition:
+            self._pending = True
+            self._deadline = max(self._deadline, self.clock() + (self.delay if delay is None else delay))
+            if self.start_thread and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"xochitl restart {self.settings.IP}", daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+
+    @contextmanager
+    def hold(self):
+        """No restart happens while in this context (eg. during a transfer)"""
+        with self._condition:
+            self._holds += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._holds -= 1
+                self._condition.notify_all()
+
+    def _due_in(self):
+        """Seconds before the pending restart is due, None if there is nothing to do"""
+        if not self._pending or self._holds > 0:
+            return None
+        return self._deadline - self.clock()
+
+    def poll(self):
+        """Restart xochitl if a restart is due, return True if it did"""
+        with self._condition:
+            due_in = self._due_in()
+            if due_in is None or due_in > 0:
+                return False
+            self._pending = False
+            self._restarting = True
+        try:
+            self.restart(self.settings)
+        except:  # noqa: E722
+            LOGGER.warning("Unable to restart xochitl", exc_info=True)
+        with self._condition:
+            self._restarting = False
+            self._restarted = True
+            self._condition.notify_all()
+        # the restarted web interface is back on its root folder
+        rm_web_interface.forget_position(self.settings.IP)
+        return True
+
+    def flush(self):
+        """Run the pending restart now"""
+        with self._condition:
+            if not self._pending:
+                return False
+            self._deadline = self.clock()
+        return self.poll()
+
+    def cancel(self):
+        with self._condition:
+            self._pending = False
+            self._condition.notify_all()
+
+    def wait_until_ready(self, timeout=READY_TIMEOUT, interval=READY_POLL_INTERVAL):
+        """
+        Wait until the web interface answers again after a restart, return False on timeout.
+        Returns immediately if xochitl was not restarted.
+        """
+        with self._condition:
+            while self._restarting:
+                self._condition.wait()
+            if not self._restarted:
+                return True
+        end = self.clock() + timeout
+        while True:
+            if self.check_connection(self.settings.IP):
+                self._restarted = False
+                return True
+            if self.clock() >= end:
+                return False
+            self.sleep(interval)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due_in = self._due_in()
+                while due_in is None or due_in > 0:
+                    self._condition.wait(due_in)
+                    due_in = self._due_in()
+            self.poll()
+
+
+_lock = threading.Lock()
+_schedulers: dict[str, RestartScheduler] = {}
+
+
+def scheduler_for(settings: RemarkableSettings) -> RestartScheduler:
+    with _lock:
+        scheduler = _schedulers.get(settings.IP)
+        if scheduler is None:
+            scheduler = _schedulers[settings.IP] = RestartScheduler(settings)
+        return scheduler
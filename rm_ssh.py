@@ -1,25 +1,41 @@
 #!/usr/bin/env python3
+import base64
+import io
+import json
 import logging
 import os
 import pathlib
+import socket
 import subprocess
+import tarfile
 import tempfile
 import threading
 import time
 import uuid
+from dataclasses import dataclass
+from typing import Callable
 
+from . import rm_stats
 from .log_helper import log_args_kwargs  # type: ignore
 from .rm_data import RemarkableSettings
 
 XOCHITL_BASE_FOLDER = "~/.local/share/remarkable/xochitl"
+DOCUMENTS_SNAPSHOT_PATH = "~/.calibre_remarkable_usb_device.documents"
 default_prepdir = tempfile.mkdtemp(prefix="resync-")
 
-ssh_socketfile = "/tmp/remarkable-push.socket"
+ssh_socketfile = os.path.join(tempfile.gettempdir(), "remarkable-push-{ip}.socket")
 ssh_options2 = ["-o", "StrictHostKeyChecking=no", "-o", "BatchMode=yes"]
 ssh_options_str = " ".join(ssh_options2)
-ssh_socket_options = f" -S {ssh_socketfile}" if os.name != "nt" else ""
+ssh_control_persist = "600"
+# OpenSSH for Windows does not support connection multiplexing
+ssh_multiplexing = os.name != "nt"
 subprocess_creation_flags = subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0
 
+_sessions_lock = threading.Lock()
+_sessions: set[str] = set()
+# called with the settings of the device whenever a command fails to reach it
+connection_error_listeners: list[Callable[[RemarkableSettings], None]] = []
+
 
 def ssh_address(settings: RemarkableSettings):
     return f"root@{settings.IP}"
@@ -27,21 +43,116 @@ def ssh_address(settings: RemarkableSettings):
     return f"root:{settings.SSH_PASSWORD}@{settings.IP}" if settings.SSH_PASSWORD else f"root@{settings.IP}"
 
 
+def ssh_socket_path(settings: RemarkableSettings):
+    return ssh_socketfile.format(ip=settings.IP)
+
+
+def ssh_socket_options(settings: RemarkableSettings):
+    """
+    Options to send a command over the device's master connection, which is (re)started when needed
+    """
+    if not ssh_multiplexing:
+        return []
+    _open_session(settings)
+    return ["-o", "ControlMaster=no", "-o", f"ControlPath={ssh_socket_path(settings)}"]
+
+
+def _is_master_alive(socket_path: str):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+def _open_session(settings: RemarkableSettings):
+    socket_path = ssh_socket_path(settings)
+    with _sessions_lock:
+        if settings.IP in _sessions and _is_master_alive(socket_path):
+            return
+        # the master died without cleaning up its socket
+        pathlib.Path(socket_path).unlink(missing_ok=True)
+        with rm_stats.measure("ssh connect") as measurement:
+            p = subprocess.run(
+                [
+                    "ssh",
+                    *ssh_options2,
+                    "-M",
+                    "-N",
+                    "-f",
+                    "-o",
+                    f"ControlPath={socket_path}",
+                    "-o",
+                    f"ControlPersist={ssh_control_persist}",
+                    "-o",
+                    "ServerAliveInterval=5",
+                    "-o",
+                    "ServerAliveCountMax=2",
+                    ssh_address(settings),
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                creationflags=subprocess_creation_flags,
+            )
+            measurement.succeeded = p.returncode == 0
+        if p.returncode == 0:
+            _sessions.add(settings.IP)
+        else:
+            # commands will fall back to a direct connection
+            logging.getLogger().debug(f"Unable to start ssh master connection, {p.returncode=}")
+
+
 @log_args_kwargs
-def xochitl_restart_after(settings: RemarkableSettings, seconds=5.0):
-    threading.Timer(seconds, lambda: xochitl_restart(settings)).start()
+def close_session(settings: RemarkableSettings):
+    """
+    Stop the master connection of the device (if any)
+    """
+    if not ssh_multiplexing:
+        return
+    socket_path = ssh_socket_path(settings)
+    with _sessions_lock:
+        _sessions.discard(settings.IP)
+        if os.path.exists(socket_path):
+            subprocess.run(
+                ["ssh", *ssh_options2, "-o", f"ControlPath={socket_path}", "-O", "exit", ssh_address(settings)],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                creationflags=subprocess_creation_flags,
+            )
+        # a master that died leaves its socket behind
+        pathlib.Path(socket_path).unlink(missing_ok=True)
+
+
+def _ssh(settings: RemarkableSettings, command: str, **kwargs):
+    socket_options = ssh_socket_options(settings)
+    with rm_stats.measure(f"ssh {command.split(' ', 1)[0]}") as measurement:
+        p = subprocess.run(
+            ["ssh", *ssh_options2, *socket_options, ssh_address(settings), command],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            creationflags=subprocess_creation_flags,
+            **kwargs,
+        )
+        measurement.bytes = len(kwargs.get("input") or "") + len(p.stdout or "")
+        measurement.succeeded = p.returncode == 0
+    if p.returncode == 255:
+        _on_connection_error(settings)
+    return p
+
+
+def _on_connection_error(settings: RemarkableSettings):
+    # the master connection is restarted on the next command
+    close_session(settings)
+    for listener in connection_error_listeners:
+        listener(settings)
 
 
 @log_args_kwargs
 def xochitl_restart(settings: RemarkableSettings):
-    p = subprocess.Popen(
-        ["ssh", *ssh_options2, ssh_address(settings), "systemctl restart xochitl"],
-        text=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        creationflags=subprocess_creation_flags,
-    )
-    p.wait()
+    p = _ssh(settings, "systemctl restart xochitl", text=True)
     if p.returncode != 0:
         raise SystemError(f"{p.returncode=}, {p.stdout}")
 
@@ -51,149 +162,333 @@ def _touch_fs(settings: RemarkableSettings):
     """
     Test if ssh is working AND home is writable
     """
-    p = subprocess.Popen(
-        ["ssh", *ssh_options2, ssh_address(settings), "touch ~/calibre_remarkable_usb_device.touch"],
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        creationflags=subprocess_creation_flags,
-    )
-    p.wait()
+    p = _ssh(settings, "touch ~/calibre_remarkable_usb_device.touch")
     return p.returncode == 0
 
 
 @log_args_kwargs
 def init_metadata(settings: RemarkableSettings):
-    p = subprocess.Popen(
-        ["ssh", *ssh_options2, ssh_address(settings), f"echo [] > {settings.CALIBRE_METADATA_PATH}"],
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        creationflags=subprocess_creation_flags,
-    )
-    p.wait()
+    p = _ssh(settings, f"echo [] > {settings.CALIBRE_METADATA_PATH}; rm -f {settings.CALIBRE_METADATA_JOURNAL_PATH}")
     return p.returncode == 0
 
 
 @log_args_kwargs
-def scp(settings: RemarkableSettings, src_file: str, dest: str):
-    p = subprocess.run(
-        ["scp", src_file, f"{ssh_address(settings)}:{dest}"],
-        text=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        creationflags=subprocess_creation_flags,
-    )
+def write(settings: RemarkableSettings, dest: str, content: str, append=False, then: str | None = None):
+    """
+    Write `content` to the remote file `dest` through the ssh connection.
+    A new file is written atomically (write to a temporary file, then rename), `then` runs only if the write succeeded
+    """
+    if append:
+        command = f"cat >> {dest}"
+    else:
+        command = f"cat > {dest}.tmp && mv {dest}.tmp {dest}"
+    if then:
+        command = f"{command} && {then}"
+    p = _ssh(settings, command, input=content, text=True)
     if p.returncode != 0:
-        raise RuntimeError(f"returncode={p.returncode}, stdout={p.stdout}")
+        raise RuntimeError(f"returncode={p.returncode}, stderr={p.stderr}")
 
 
 @log_args_kwargs
-def test_connection(settings: RemarkableSettings):
+def stream(settings: RemarkableSettings, command: str, chunks) -> "SshCommandResult":
     """
-    Test if ssh is working AND home is writable
+    Run `command` with the `chunks` (bytes) written to its stdin as they are produced, without holding them all in memory
+    """
+    socket_options = ssh_socket_options(settings)
+    with rm_stats.measure(f"ssh {command.split(' ', 1)[0]}") as measurement:
+        p = subprocess.Popen(
+            ["ssh", *ssh_options2, *socket_options, ssh_address(settings), command],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            creationflags=subprocess_creation_flags,
+        )
+        try:
+            for chunk in chunks:
+                p.stdin.write(chunk)
+                measurement.bytes += len(chunk)
+        except BrokenPipeError:
+            # the connection dropped, the return code tells
+            pass
+        except:  # noqa: E722
+            p.kill()
+            p.wait()
+            raise
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
+        stderr = p.stderr.read().decode("utf-8", errors="replace")
+        p.wait()
+        measurement.succeeded = p.returncode == 0
+    if p.returncode == 255:
+        _on_connection_error(settings)
+    return SshCommandResult(command, p.returncode, stderr.strip())
+
+
+@log_args_kwargs
+def run(settings: RemarkableSettings, command: str) -> "SshCommandResult":
+    p = _ssh(settings, command, text=True)
+    return SshCommandResult(command, p.returncode, (p.stdout + p.stderr).strip())
+
+
+@log_args_kwargs
+def probe_connection(settings: RemarkableSettings):
+    """
+    Return (ssh is working, home is writable), the filesystem is remounted read-write if needed
     """
     try:
         rw_success = _touch_fs(settings)
         if not rw_success:
-            p = subprocess.Popen(
-                ["ssh", *ssh_options2, ssh_address(settings), "mount -o remount,rw /"],
-                shell=False,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                creationflags=subprocess_creation_flags,
-            )
-            p.wait()
-            return p.returncode == 0
-        return True
+            p = _ssh(settings, "mount -o remount,rw /")
+            return p.returncode != 255, p.returncode == 0
+        return True, True
     except:  # noqa: E722
         logging.warn("SSH connection failed", exc_info=True)
-        return False
+        return False, False
 
 
 @log_args_kwargs
-def sed(settings: RemarkableSettings, xochitl_filename, i: str, o: str):
-    p = subprocess.Popen(
-        (
-            "ssh",
-            *ssh_options2,
-            ssh_address(settings),
-            f"sed -i -e 's/{i}/{o}/g' {XOCHITL_BASE_FOLDER}/{xochitl_filename}",
-        ),
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        creationflags=subprocess_creation_flags,
-    )
-    p.wait()
+def test_connection(settings: RemarkableSettings):
+    """
+    Test if ssh is working AND home is writable
+    """
+    _, is_writable = probe_connection(settings)
+    return is_writable
 
 
-@log_args_kwargs
-def get_latest_upload_uuid(settings: RemarkableSettings):
-    p = subprocess.run(
-        ["ssh", *ssh_options2, ssh_address(settings), f"cd {XOCHITL_BASE_FOLDER}; ls -Art *.metadata | tail -n 1"],
-        text=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        creationflags=subprocess_creation_flags,
-    )
-    return p.stdout.strip().replace(".metadata", "")
+def _documents_generation_command():
+    # sub-second mtime and entry count: two changes within the same second still change the marker
+    return f"stat -c '%n %i %y' {XOCHITL_BASE_FOLDER} && ls -f {XOCHITL_BASE_FOLDER} | wc -l"
 
 
-@log_args_kwargs
-def rm(settings: RemarkableSettings, paths: list[str]):
-    p = subprocess.run(
-        ["ssh", *ssh_options2, ssh_address(settings), f"cd {XOCHITL_BASE_FOLDER}; rm {paths} -Rf"],
-        text=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        creationflags=subprocess_creation_flags,
-    )
-    return p.stdout.strip()
+def _metadata_generation_command(settings: RemarkableSettings):
+    return f"stat -c '%n %i %s %y' {settings.CALIBRE_METADATA_PATH} {settings.CALIBRE_METADATA_JOURNAL_PATH} 2>/dev/null; true"
+
+
+GENERATION_SEPARATOR = "--"
 
 
 @log_args_kwargs
-def cat(settings: RemarkableSettings, file: str):
-    p = subprocess.run(
-        ["ssh", *ssh_options2, ssh_address(settings), f"cat {file}"],
-        text=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        creationflags=subprocess_creation_flags,
-    )
+def generation(settings: RemarkableSettings):
+    """
+    A marker that changes whenever documents are added/removed/rewritten or the calibre metadata changes on the device.
+    It is made of the part of the documents and the part of the calibre metadata, see with_metadata_generation
+    """
+    p = _ssh(settings, f"{_documents_generation_command()} && echo {GENERATION_SEPARATOR} && {_metadata_generation_command(settings)}", text=True)
     if p.returncode != 0:
         return None
+    return p.stdout.strip() or None
 
-    result = p.stdout.strip()
-    logging.getLogger().debug(f"cat {result=}")
-    return result
+
+def split_generation(generation: str | None) -> tuple[str, str] | None:
+    """The (documents, calibre metadata) parts of `generation`, None if it is unknown"""
+    if generation is None:
+        return None
+    documents, separator, metadata = generation.partition(f"\n{GENERATION_SEPARATOR}")
+    if not separator:
+        return None
+    return documents, metadata.strip()
 
 
 @log_args_kwargs
-def mkdir(settings: RemarkableSettings, visible_name, parent_id=""):
-    file_id = str(uuid.uuid4())
-    with tempfile.TemporaryDirectory() as tmp_folder:
-        file_metadata = f"{file_id}.metadata"
-        file_content = f"{file_id}.content"
-        current_timestamp_str = str(int(time.time()))
-        with open(pathlib.Path(tmp_folder, file_metadata), "w+") as fp:
-            metadata_json = (
-                '{"createdTime": "'
-                + current_timestamp_str
-                + '",    "lastModified": "'
-                + current_timestamp_str
-                + '",    "parent": "'
-                + parent_id
-                + '",    "pinned": false,    "type": "CollectionType",    "visibleName": "'
-                + visible_name
-                + '"}'
-            )
-            fp.write(metadata_json)
-        with open(pathlib.Path(tmp_folder, file_content), "w+") as fp:
-            content_json = """{"tags": []}"""
-            fp.write(content_json)
-
-        cmd = f"scp -r {tmp_folder}/* {ssh_address(settings)}:{XOCHITL_BASE_FOLDER}"
-        result = subprocess.getoutput(cmd)
-        logging.getLogger().debug(result)
-    return file_id
+def with_metadata_generation(settings: RemarkableSettings, generation: str | None):
+    """
+    `generation` with its calibre metadata part read again, for a state that was read at `generation` and whose calibre metadata
+    was rewritten since. The documents keep their part: any change made to them in the meantime still invalidates the state
+    """
+    parts = split_generation(generation)
+    if parts is None:
+        return None
+    documents, _ = parts
+    p = _ssh(settings, _metadata_generation_command(settings), text=True)
+    if p.returncode != 0:
+        return None
+    # same layout as generation()
+    return f"{documents}\n{GENERATION_SEPARATOR}\n{p.stdout.strip()}".strip()
+
+
+def collection_metadata_json(visible_name: str, parent_id=""):
+    current_timestamp_str = str(int(time.time()))
+    return (
+        '{"createdTime": "'
+        + current_timestamp_str
+        + '",    "lastModified": "'
+        + current_timestamp_str
+        + '",    "parent": "'
+        + parent_id
+        + '",    "pinned": false,    "type": "CollectionType",    "visibleName": "'
+        + visible_name
+        + '"}'
+    )
+
+
+COLLECTION_CONTENT_JSON = """{"tags": []}"""
+
+
+def sed_replacement(text: str):
+    """Escape `text` to be the replacement of a sed `s` command, itself in a single-quoted shell argument"""
+    return text.replace("\\", "\\\\").replace("/", "\\/").replace("&", "\\&").replace("'", "'\\''")
+
+
+@dataclass
+class SshCommandResult:
+    command: str
+    returncode: int
+    output: str
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+
+class SshBatch:
+    """
+    Queue remote commands and run them all in a single ssh invocation.
+    Each command runs in its own subshell, its output (stdout and stderr) and return code are reported separately.
+    """
+
+    def __init__(self, settings: RemarkableSettings):
+        self.settings = settings
+        self.commands: list[str] = []
+        self.marker = f"__calibre_remarkable_batch_{uuid.uuid4().hex}"
+
+    def __len__(self):
+        return len(self.commands)
+
+    def add(self, command: str) -> int:
+        """Queue a command, return the index of its result"""
+        self.commands.append(command)
+        return len(self.commands) - 1
+
+    def move_document(self, document_uuid: str, parent_id: str, visible_name: str) -> int:
+        """Queue moving the document to the folder `parent_id` under the name `visible_name`"""
+        return self.add(
+            f"sed -i -e 's/\"parent\": *\"[^\"]*\"/\"parent\": \"{parent_id}\"/'"
+            f" -e 's/\"visibleName\": *\"[^\"]*\"/\"visibleName\": {sed_replacement(json.dumps(visible_name, ensure_ascii=False))}/'"
+            f" {XOCHITL_BASE_FOLDER}/{document_uuid}.metadata"
+        )
+
+    def set_parent(self, document_uuid: str, parent_id: str) -> int:
+        """Queue moving the document to the folder `parent_id`, the output is `moved` if it was in another folder"""
+        path = f"{XOCHITL_BASE_FOLDER}/{document_uuid}.metadata"
+        return self.add(
+            f"grep -q '\"parent\": *\"{parent_id}\"' {path}"
+            f" || {{ sed -i -e 's/\"parent\": *\"[^\"]*\"/\"parent\": \"{parent_id}\"/' {path} && echo moved; }}"
+        )
+
+    def snapshot_documents(self) -> int:
+        """Save the list of the documents on the device (on the device), see `new_documents`"""
+        # no glob: `ls *.metadata` fails on a tablet without any document yet
+        return self.add(f"cd {XOCHITL_BASE_FOLDER}; ls | grep '\\.metadata$' > {DOCUMENTS_SNAPSHOT_PATH}; true")
+
+    def new_documents(self) -> int:
+        """
+        The output is one `<uuid>\\t<visibleName>` line per document created since `snapshot_documents`
+        """
+        return self.add(
+            f"cd {XOCHITL_BASE_FOLDER}; ls | grep '\\.metadata$' | grep -vxF -f {DOCUMENTS_SNAPSHOT_PATH} | while read f; do"
+            """ printf '%s\\t%s\\n' "${f%.metadata}" "$(sed -n 's/.*"visibleName": *"\\([^"]*\\)".*/\\1/p' "$f" | head -n 1)"; done"""
+        )
+
+    @staticmethod
+    def write_command(dest: str, content: str, append=False, then: str | None = None) -> str:
+        """Command writing `content` to `dest`, see `write`"""
+        encoded = base64.b64encode(content.encode("utf-8")).decode("ascii")
+        if append:
+            command = f"printf '%s' {encoded} | base64 -d >> {dest}"
+        else:
+            command = f"printf '%s' {encoded} | base64 -d > {dest}.tmp && mv {dest}.tmp {dest}"
+        if then:
+            command = f"{command} && {then}"
+        return command
+
+    def write(self, dest: str, content: str, append=False, then: str | None = None) -> int:
+        """Queue the write of `content` to `dest`, see `write`"""
+        return self.add(self.write_command(dest, content, append=append, then=then))
+
+    def rm_documents(self, document_uuids: list[str]) -> int:
+        """
+        Queue the removal of the documents with all their files (annotations, thumbnails, ...).
+        The folder is listed once, instead of expanding a glob per document
+        """
+        select = 'BEGIN { n = split(uuids, u, " "); for (i = 1; i <= n; i++) selected[u[i]] } $1 in selected'
+        return self.add(f"cd {XOCHITL_BASE_FOLDER} && ls -A | awk -F. -v uuids='{' '.join(document_uuids)}' '{select}' | xargs -r rm -rf --")
+
+    def mkdirs(self, collections: list["NewCollection"]) -> int:
+        """Queue the creation of all the collections, sent as a single archive"""
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            for c in collections:
+                for name, content in (
+                    (f"{c.id}.metadata", collection_metadata_json(c.visible_name, c.parent_id)),
+                    (f"{c.id}.content", COLLECTION_CONTENT_JSON),
+                ):
+                    data = content.encode("utf-8")
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = int(time.time())
+                    tar.addfile(info, io.BytesIO(data))
+        encoded = base64.b64encode(archive.getvalue()).decode("ascii")
+        return self.add(f"printf '%s' {encoded} | base64 -d | tar -xz -C {XOCHITL_BASE_FOLDER}")
+
+    def script(self, commands: list[str]):
+        return "\n".join(f"( {command} ) 2>&1; printf '\\n%s %s\\n' {self.marker} $?" for command in commands)
+
+    @log_args_kwargs
+    def run(self) -> list[SshCommandResult]:
+        """Run all the queued commands, then empty the queue"""
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        p = _ssh(self.settings, "sh -s", input=self.script(commands), text=True)
+
+        results: list[SshCommandResult] = []
+        output: list[str] = []
+        for line in p.stdout.splitlines():
+            if line.startswith(self.marker):
+                returncode = int(line[len(self.marker) :].strip() or 255)
+                results.append(SshCommandResult(commands[len(results)], returncode, "\n".join(output).strip()))
+                output = []
+            else:
+                output.append(line)
+        # the connection dropped before the end of the script
+        results.extend(SshCommandResult(command, p.returncode or 255, "") for command in commands[len(results) :])
+        return results
+
+
+@dataclass
+class NewCollection:
+    id: str
+    visible_name: str
+    parent_id: str = ""
+
+
+@dataclass
+class FolderPlan:
+    # folder of each upload, "" for the root
+    folder_ids: list[str]
+    new_collections: list[NewCollection]
+
+
+def plan_folders(upload_paths: list[str], existing_folders: dict[str, str]) -> FolderPlan:
+    """
+    Compute the folder of each upload path ('folder/subfolder/file') and the minimal set of collections to create,
+    `existing_folders` maps the existing folder paths to their id. Ids of new collections are assigned locally.
+    """
+    known_folders = dict(existing_folders)
+    plan = FolderPlan([], [])
+    for upload_path in upload_paths:
+        parts = upload_path.split("/")[:-1] if upload_path else []
+        folder_id = ""
+        for i in range(len(parts)):
+            part_full = "/".join(parts[: i + 1])
+            parent_folder_id = folder_id
+            folder_id = known_folders.get(part_full, "")
+            if not folder_id:
+                collection = NewCollection(str(uuid.uuid4()), parts[i], parent_folder_id)
+                plan.new_collections.append(collection)
+                folder_id = known_folders[part_full] = collection.id
+        plan.folder_ids.append(folder_id)
+    return plan
@@ -0,0 +1,169 @@
+"""
+Upload books by writing the xochitl files through ssh, instead of posting them to the web interface.
+
+The book is streamed into a staging file named after its sha256: an interrupted transfer resumes from the end of
+the staging file. Once the checksum of the staging file matches, it is moved into the xochitl folder
+along with the .content and .metadata of the document. xochitl only shows the new documents after a restart.
+"""
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from . import rm_ssh
+from .log_helper import log_args_kwargs
+from .rm_data import RemarkableSettings
+from .rm_web_interface import UploadResult, report_progress
+
+STAGING_FOLDER = "~/.calibre_remarkable_usb_device.uploads"
+CHUNK_SIZE = 1024 * 1024
+MAX_ATTEMPTS = 3
+
+LOGGER = logging.getLogger()
+
+# the staging file of a content is shared by the books with that content: their uploads take turns
+_staging_locks_lock = threading.Lock()
+_staging_locks: dict[str, threading.Lock] = {}
+
+
+def _staging_lock(staging_path: str) -> threading.Lock:
+    with _staging_locks_lock:
+        return _staging_locks.setdefault(staging_path, threading.Lock())
+
+
+def sha256_file(local_path: str, chunk_size=CHUNK_SIZE) -> str:
+    h = hashlib.sha256()
+    with open(local_path, "rb") as fp:
+        while chunk := fp.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def document_metadata_json(visible_name: str, parent_id=""):
+    return json.dumps(
+        {
+            "deleted": False,
+            "lastModified": str(int(time.time() * 1000)),
+            "lastOpened": "0",
+            "lastOpenedPage": 0,
+            "metadatamodified": False,
+            "modified": False,
+            "parent": parent_id,
+            "pinned": False,
+            "synced": False,
+            "type": "DocumentType",
+            "version": 0,
+            "visibleName": visible_name,
+        },
+        indent=4,
+    )
+
+
+def document_content_json(file_type: str):
+    return json.dumps({"fileType": file_type}, indent=4)
+
+
+def _read_from(local_path: str, offset: int, chunk_size=CHUNK_SIZE):
+    with open(local_path, "rb") as fp:
+        fp.seek(offset)
+        while chunk := fp.read(chunk_size):
+            yield chunk
+
+
+def _transfer(settings: RemarkableSettings, local_path: str, staging_path: str, checksum: str, progress_callback=None):
+    """Send the book to `staging_path`, resuming from what is already there, until its checksum matches"""
+    total = os.path.getsize(local_path)
+    for attempt in range(MAX_ATTEMPTS):
+        result = rm_ssh.run(settings, f"mkdir -p {STAGING_FOLDER} && (stat -c %s {staging_path} 2>/dev/null || echo 0)")
+        if not result.ok:
+            LOGGER.warning(f"Unable to check the transfer of {local_path}: {result}")
+            continue
+        offset = int(result.output.splitlines()[-1])
+        if offset > total:
+            rm_ssh.run(settings, f"rm -f {staging_path}")
+            offset = 0
+        if offset > 0:
+            LOGGER.info(f"Resuming the transfer of {local_path} from {offset}/{total} bytes")
+
+        if offset < total:
+            # the progress covers the whole book, including what was sent by the previous attempts
+            report = (lambda sent, _, offset=offset: progress_callback(offset + sent, total)) if progress_callback else None
+            chunks = report_progress(_read_from(local_path, offset), total - offset, report)
+            result = rm_ssh.stream(settings, f"cat >> {staging_path}", chunks)
+            if not result.ok:
+                LOGGER.warning(f"Transfer of {local_path} interrupted (attempt {attempt + 1}/{MAX_ATTEMPTS}): {result}")
+                continue
+
+        result = rm_ssh.run(settings, f"sha256sum {staging_path}")
+        if result.ok and result.output.split(" ", 1)[0] == checksum:
+            return
+        LOGGER.warning(f"Checksum mismatch for {local_path} (attempt {attempt + 1}/{MAX_ATTEMPTS}), sending it again")
+        rm_ssh.run(settings, f"rm -f {staging_path}")
+    raise RuntimeError(f"Unable to transfer {local_path} after {MAX_ATTEMPTS} attempts")
+
+
+@log_args_kwargs
+def upload_file(settings: RemarkableSettings, local_path: str, folder_id: str, visible_name: str, progress_callback=None, checksum=None) -> str:
+    """
+    Upload the book as a new document of the folder `folder_id`, return the uuid of the document.
+    `checksum` is the sha256 of the book, if already known
+    """
+    checksum = checksum or sha256_file(local_path)
+    # named after the content so that an interrupted transfer resumes, even from another upload of the same book
+    staging_path = f"{STAGING_FOLDER}/{checksum}.part"
+    name, ext = posixpath.splitext(visible_name)
+    file_type = ext.lower().lstrip(".")
+    document_uuid = str(uuid.uuid4())
+    document_path = f"{rm_ssh.XOCHITL_BASE_FOLDER}/{document_uuid}"
+    # the .metadata goes last: it is what makes the document exist
+    command = " && ".join(
+        [
+            f"mv {staging_path} {document_path}.{file_type}",
+            rm_ssh.SshBatch.write_command(f"{document_path}.content", document_content_json(file_type)),
+            rm_ssh.SshBatch.write_command(f"{document_path}.metadata", document_metadata_json(name, folder_id)),
+        ]
+    )
+    # two books with the same content in a parallel batch must not append to the staging file, or move it, at the same time
+    with _staging_lock(staging_path):
+        _transfer(settings, local_path, staging_path, checksum, progress_callback)
+        result = rm_ssh.run(settings, command)
+    if not result.ok:
+        raise RuntimeError(f"Unable to create the document of {local_path}: {result}")
+    return document_uuid
+
+
+def upload_files(
+    settings: RemarkableSettings,
+    uploads: list[tuple[str, str, str]],
+    max_workers=1,
+    on_complete=None,
+    checksums: list[str] | None = None,
+    progress_callback=None,
+) -> list[UploadResult]:
+    """
+    Same as rm_web_interface.upload_files, the response of a successful upload is the uuid of its document.
+    The documents are created in their folder, there is no current folder to position
+    """
+
+    def upload(index: int):
+        local_path, folder_id, visible_name = uploads[index]
+        checksum = checksums[index] if checksums else None
+        report = (lambda sent, total: progress_callback(index, sent, total)) if progress_callback else None
+        try:
+            result = UploadResult(
+                local_path, response=upload_file(settings, local_path, folder_id, visible_name, progress_callback=report, checksum=checksum)
+            )
+        except Exception as e:
+            LOGGER.warning(f"Unable to upload {local_path}", exc_info=True)
+            result = UploadResult(local_path, error=e)
+        if on_complete:
+            on_complete(index, result)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        return list(executor.map(upload, range(len(uploads))))
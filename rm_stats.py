@@ -0,0 +1,120 @@
+"""
+Opt-in timing of the device operations: ssh commands, web interface requests and the plugin entry points.
+
+It is enabled by the "Timing report" customization, the path of the JSON report giving, per operation,
+the number of calls and failures, the bytes transferred and the p50/p95/max durations.
+Recording is a no-op while it is disabled.
+"""
+import json
+import logging
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+# durations kept per operation for the percentiles, the counts cover all the calls
+SAMPLES_PER_OPERATION = 10000
+
+LOGGER = logging.getLogger()
+
+enabled = False
+report_path = ""
+
+
+@dataclass
+class _OperationStats:
+    count: int = 0
+    failures: int = 0
+    bytes: int = 0
+    durations: deque = field(default_factory=lambda: deque(maxlen=SAMPLES_PER_OPERATION))
+
+
+_lock = threading.Lock()
+_operations: dict[str, _OperationStats] = {}
+
+
+def configure(path: str):
+    """Enable the recording if `path` (where the report is written) is set"""
+    global enabled, report_path
+    report_path = path.strip()
+    enabled = bool(report_path)
+
+
+def record(operation: str, duration: float, nbytes=0, succeeded=True):
+    if not enabled:
+        return
+    with _lock:
+        stats = _operations.get(operation)
+        if stats is None:
+            stats = _operations[operation] = _OperationStats()
+        stats.count += 1
+        stats.failures += not succeeded
+        stats.bytes += nbytes
+        stats.durations.append(duration)
+
+
+class Measurement:
+    __slots__ = ("bytes", "succeeded")
+
+    def __init__(self):
+        self.bytes = 0
+        self.succeeded = True
+
+
+@contextmanager
+def measure(operation: str):
+    """
+    Record the block as one call of `operation`. The block can count the bytes it transferred in `.bytes`,
+    and report a failure that is not an exception with `.succeeded`
+    """
+    measurement = Measurement()
+    if not enabled:
+        yield measurement
+        return
+    start = time.perf_counter()
+    try:
+        yield measurement
+    except BaseException:
+        measurement.succeeded = False
+        raise
+    finally:
+        record(operation, time.perf_counter() - start, measurement.bytes, measurement.succeeded)
+
+
+def _percentile(sorted_durations: list[float], percent: float):
+    """Nearest-rank percentile"""
+    return sorted_durations[max(0, math.ceil(percent / 100 * len(sorted_durations)) - 1)]
+
+
+def report() -> dict:
+    with _lock:
+        operations = {name: (stats.count, stats.failures, stats.bytes, sorted(stats.durations)) for name, stats in _operations.items()}
+    return {
+        name: {
+            "count": count,
+            "failures": failures,
+            "bytes": nbytes,
+            "p50_ms": round(_percentile(durations, 50) * 1000, 3),
+            "p95_ms": round(_percentile(durations, 95) * 1000, 3),
+            "max_ms": round(durations[-1] * 1000, 3),
+        }
+        for name, (count, failures, nbytes, durations) in operations.items()
+    }
+
+
+def write_report():
+    """Write the report to the configured path, if enabled"""
+    if not enabled:
+        return
+    try:
+        with open(report_path, "w", encoding="utf-8") as fp:
+            json.dump(report(), fp, indent=1, sort_keys=True)
+    except OSError:
+        LOGGER.warning(f"Unable to write the timing report to {report_path}", exc_info=True)
+
+
+def reset():
+    with _lock:
+        _operations.clear()
@@ -1,15 +1,29 @@
 # %%
 import dataclasses
-import io
+import http.client
 import json
 import logging
 import mimetypes
+import os
+import select
+import sys
+import threading
 import uuid
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from enum import Enum
-from urllib import request
+from types import MappingProxyType
+from typing import Mapping
+from urllib.error import HTTPError
+
+from . import rm_stats
 
 HEADERS__CONTENT_TYPE__JSON = {"Content-Type": "application/json"}
 HEADERS__CHARSET__ISO88591 = {"charset": "ISO-8859-1"}
+QUERY_TREE_MAX_WORKERS = 8
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_MAX_WORKERS = 2
+HTTP_TIMEOUT = 60.0
+HTTP_POOL_MAX_IDLE = 8
 
 
 # %%
@@ -18,7 +32,7 @@ class TypeOfDocument(str, Enum):
     CollectionType = "CollectionType"
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True)
 class Document:
     # Bookmarked
     # CurrentPage': 6,
@@ -31,71 +45,121 @@ class Document:
 
     @classmethod
     def parse(cls, d: dict):
+        # folder ids are shared by the Parent of all their children, the types come from a handful of values
+        doc_type = sys.intern(str(d.get("Type")))
         return Document(
-            d["ID"],
-            d["Parent"],
-            str(d.get("Type")),
+            sys.intern(d["ID"]) if doc_type == TypeOfDocument.CollectionType else d["ID"],
+            sys.intern(d["Parent"]),
+            doc_type,
             str(d.get("VissibleName", "")),
-            str(d.get("fileType")),
+            sys.intern(str(d.get("fileType"))),
         )
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True)
+class TreeIndex:
+    """
+    Flattened view of a tree, in depth-first order. Paths are the visible names joined with '/'.
+    Read-only (tuples and mapping proxies): the ls_* views return it without copying
+    """
+
+    path_to_id: Mapping[str, str]
+    dir_path_to_id: Mapping[str, str]
+    dir_paths: tuple[str, ...]
+    document_paths: tuple[str, ...]
+    document_ids: tuple[str, ...]
+    id_to_path: Mapping[str, str]
+    id_to_node: Mapping[str, "ChildNode"]
+
+
+@dataclasses.dataclass(slots=True)
 class Node:
     children: list["ChildNode"]
+    # built on first use, the tree must not be modified afterwards
+    _index: TreeIndex | None = dataclasses.field(default=None, init=False, repr=False, compare=False)
 
     @classmethod
     def new_empty(cls):
         return Node([])
 
-    def ls_recursive(self: "Node"):
-        result = []
-        for c in self.children:
+    @property
+    def index(self) -> TreeIndex:
+        if self._index is None:
+            self._index = self._build_index()
+        return self._index
+
+    def _build_index(self):
+        path_to_id: dict[str, str] = {}
+        dir_path_to_id: dict[str, str] = {}
+        dir_paths: list[str] = []
+        document_paths: list[str] = []
+        document_ids: list[str] = []
+        id_to_path: dict[str, str] = {}
+        id_to_node: dict[str, ChildNode] = {}
+        stack: list[tuple[str, ChildNode]] = [("", c) for c in reversed(self.children)]
+        while stack:
+            prefix, c = stack.pop()
+            path = prefix + c.visible_name
+            doc_id = c.document.ID
+            path_to_id[path] = doc_id
+            id_to_path[doc_id] = path
+            id_to_node[doc_id] = c
             if c.document.Type == TypeOfDocument.CollectionType:
-                ls_children = list(map(lambda path: f"{c.visible_name}/{path}", c.ls_recursive()))
-                result.extend(ls_children)
+                dir_path_to_id[path] = doc_id
+                dir_paths.append(path)
+                stack.extend((f"{path}/", cc) for cc in reversed(c.children))
             else:
-                result.append(c.visible_name)
-        return result
+                document_paths.append(path)
+                document_ids.append(doc_id)
+        return TreeIndex(
+            MappingProxyType(path_to_id),
+            MappingProxyType(dir_path_to_id),
+            tuple(dir_paths),
+            tuple(document_paths),
+            tuple(document_ids),
+            MappingProxyType(id_to_path),
+            MappingProxyType(id_to_node),
+        )
+
+    def ls_recursive(self: "Node"):
+        return self.index.document_paths
 
     def ls_uuid(self: "Node"):
-        result = []
-        for c in self.children:
-            if c.document.Type == TypeOfDocument.CollectionType:
-                result.extend(c.ls_uuid())
-            else:
-                result.append(c.document.ID)
-        return result
+        return self.index.document_ids
 
     def ls_dir_recursive(self: "Node"):
-        result = []
-        for c in self.children:
-            if c.document.Type == TypeOfDocument.CollectionType:
-                result.append(c.visible_name)
-                ls_children = list(map(lambda path: f"{c.visible_name}/{path}", c.ls_dir_recursive()))
-                result.extend(ls_children)
-        return result
+        return self.index.dir_paths
 
     def ls_dir_recursive_dict(self: "Node"):
-        result = {}
-        for c in self.children:
-            if c.document.Type == TypeOfDocument.CollectionType:
-                result[c.visible_name] = c.document.ID
-                result.update({f"{c.visible_name}/{name}": id for name, id in c.ls_dir_recursive_dict().items()})
-        return result
+        return self.index.dir_path_to_id
 
     def ls_recursive_dict(self: "Node"):
-        result = {}
-        for c in self.children:
-            if c.document.Type == TypeOfDocument.CollectionType:
-                result[c.visible_name] = c.document.ID
-                result.update({f"{c.visible_name}/{name}": id for name, id in c.ls_recursive_dict().items()})
-            else:
-                result[c.visible_name] = c.document.ID
-        return result
+        return self.index.path_to_id
 
+    def filter_children(self, keep) -> "Node":
+        """Tree made of the children for which `keep(child)` is true, the other subtrees are not walked"""
+        return Node([c for c in self.children if keep(c)])
 
-@dataclasses.dataclass
+    def dir_ids_along(self, paths: list[str]) -> dict[str, str]:
+        """
+        {folder path: id} of the existing folders leading to each of `paths` ('folder/subfolder/file'),
+        only the folders along these paths are walked
+        """
+        dir_ids: dict[str, str] = {}
+        for path in paths:
+            node: Node = self
+            folder_path = ""
+            for name in path.split("/")[:-1]:
+                child = next((c for c in node.children if c.document.Type == TypeOfDocument.CollectionType and c.visible_name == name), None)
+                if child is None:
+                    break
+                node = child
+                folder_path = f"{folder_path}/{name}" if folder_path else name
+                dir_ids[folder_path] = child.document.ID
+        return dir_ids
+
+
+@dataclasses.dataclass(slots=True)
 class ChildNode(Node):
     document: Document
 
@@ -104,6 +168,47 @@ class ChildNode(Node):
         return self.document.VissibleName
 
 
+class LazyNode(Node):
+    """
+    Folder whose children are fetched from the device the first time they are accessed, and kept afterwards.
+    Its sub-folders are lazy as well: only the folders that are actually walked are ever fetched
+    """
+
+    def __init__(self, ip, folder_id=""):
+        self.ip = ip
+        self.folder_id = folder_id
+        self._children: list[ChildNode] | None = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._children is not None
+
+    @property
+    def children(self) -> list[ChildNode]:  # type: ignore[override]
+        with self._lock:
+            if self._children is None:
+                self._children = [_child_node(self.ip, d) for d in query_children(self.ip, self.folder_id)]
+            return self._children
+
+    def __repr__(self):
+        # logging a tree must not fetch it
+        return f"{type(self).__name__}({self.folder_id!r}, loaded={self.loaded})"
+
+
+class LazyChildNode(LazyNode, ChildNode):
+    def __init__(self, ip, document: Document):
+        super().__init__(ip, document.ID)
+        self.document = document
+
+
+def _child_node(ip, d: Document) -> ChildNode:
+    if d.Type == TypeOfDocument.CollectionType:
+        return LazyChildNode(ip, d)
+    return ChildNode([], document=d)
+
+
 class MultiPartForm:
     """Accumulate the data to be used when posting a form."""
 
@@ -123,11 +228,11 @@ class MultiPartForm:
         self.form_fields.append((name, value))
 
     def add_file(self, fieldname, filename, fileHandle, mimetype=None):
-        """Add a file to be uploaded."""
-        body = fileHandle.read()
+        """Add a file to be uploaded. The file is only read when the body is streamed."""
         if mimetype is None:
             mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
-        self.files.append((fieldname, filename, mimetype, body))
+        size = os.fstat(fileHandle.fileno()).st_size - fileHandle.tell()
+        self.files.append((fieldname, filename, mimetype, fileHandle, size))
         return
 
     @staticmethod
@@ -147,55 +252,215 @@ class MultiPartForm:
     def _content_type(ct):
         return "Content-Type: {}\r\n".format(ct).encode("utf-8")
 
-    def __bytes__(self):
-        """Return a byte-string representing the form data,
-        including attached files.
-        """
-        buffer = io.BytesIO()
+    def _parts(self):
+        """Yield the parts of the body, file parts are yielded as (file handle, size)"""
         boundary = b"--" + self.boundary + b"\r\n"
 
         # Add the form fields
         for name, value in self.form_fields:
-            buffer.write(boundary)
-            buffer.write(self._form_data(name))
-            buffer.write(b"\r\n")
-            buffer.write(value.encode("utf-8"))
-            buffer.write(b"\r\n")
+            yield boundary + self._form_data(name) + b"\r\n" + value.encode("utf-8") + b"\r\n"
 
         # Add the files to upload
-        for f_name, filename, f_content_type, body in self.files:
-            buffer.write(boundary)
-            buffer.write(self._attached_file(f_name, filename))
-            buffer.write(self._content_type(f_content_type))
-            buffer.write(b"\r\n")
-            buffer.write(body)
-            buffer.write(b"\r\n")
+        for f_name, filename, f_content_type, fileHandle, size in self.files:
+            yield boundary + self._attached_file(f_name, filename) + self._content_type(f_content_type) + b"\r\n"
+            yield fileHandle, size
+            yield b"\r\n"
+
+        yield b"--" + self.boundary + b"--\r\n"
+
+    def __len__(self):
+        """Content-Length of the form data, computed without reading the files"""
+        return sum(part[1] if isinstance(part, tuple) else len(part) for part in self._parts())
+
+    def iter_chunks(self, chunk_size=UPLOAD_CHUNK_SIZE):
+        """Stream the form data, files are read from disk `chunk_size` bytes at a time"""
+        for part in self._parts():
+            if not isinstance(part, tuple):
+                yield part
+                continue
+            fileHandle, remaining = part
+            while remaining > 0:
+                chunk = fileHandle.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise IOError(f"{fileHandle.name} was truncated during upload")
+                remaining -= len(chunk)
+                yield chunk
 
-        buffer.write(b"--" + self.boundary + b"--\r\n")
-        return buffer.getvalue()
+    def __bytes__(self):
+        """Return a byte-string representing the form data,
+        including attached files.
+        """
+        return b"".join(self.iter_chunks())
+
+
+def report_progress(chunks, total: int, progress_callback=None):
+    """Pass the chunks through, calling `progress_callback(bytes_sent, total)` after each one"""
+    sent = 0
+    for chunk in chunks:
+        yield chunk
+        sent += len(chunk)
+        if progress_callback:
+            progress_callback(sent, total)
 
 
 # %%
 
 
-def query_document(ip, path_id, **kwargs):
-    base_url = f"http://{ip}"
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent (keep-alive) HTTP connections to one device.
+    A request sent on a connection the device has closed in the meantime is retried once on a new connection,
+    unless it is not idempotent and was fully sent.
+    """
+
+    # errors raised when reusing a connection the server has closed
+    STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError, ConnectionAbortedError)
+    # methods that can be sent again once the server may have processed them
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, ip, max_idle=HTTP_POOL_MAX_IDLE, timeout=HTTP_TIMEOUT):
+        self.ip = ip
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle: list[http.client.HTTPConnection] = []
+        # folder the web interface uploads to, None if unknown
+        self.current_folder: str | None = None
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if not self._is_dropped(conn):
+                return conn, True
+            conn.close()
+        return http.client.HTTPConnection(self.ip, timeout=self.timeout), False
+
+    @staticmethod
+    def _is_dropped(conn: http.client.HTTPConnection):
+        """
+        The device closed the idle connection (like urllib3's is_connection_dropped): an idle connection has nothing to read,
+        it is readable once the device closed or reset it. A small POST sent on it would only fail when reading its response,
+        too late to be retried
+        """
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _release(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def request(self, method: str, path: str, body=None, headers=None, timeout=None) -> bytes:
+        """
+        Send the request and return the response body. `body` can be a function returning the body,
+        so that it can be produced again if the request is retried.
+        Raises urllib.error.HTTPError if the response status is an error
+        """
+        with rm_stats.measure(f"http {method} /{path.split('/')[1]}") as measurement:
+            data = self._request(method, path, body, headers, timeout)
+            measurement.bytes = int((headers or {}).get("Content-Length", 0)) + len(data)
+            return data
+
+    def _request(self, method: str, path: str, body, headers, timeout) -> bytes:
+        while True:
+            conn, reused = self._acquire()
+            conn.timeout = self.timeout if timeout is None else timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            sent = False
+            try:
+                conn.request(method, path, body=body() if callable(body) else body, headers=headers or {})
+                sent = True
+                response = conn.getresponse()
+                data = response.read()
+            except self.STALE_CONNECTION_ERRORS:
+                conn.close()
+                # a request that was fully sent may have been processed (eg. an upload that created its document)
+                if reused and (not sent or method in self.IDEMPOTENT_METHODS):
+                    continue
+                raise
+            except:  # noqa: E722
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            if response.status >= 400:
+                raise HTTPError(f"http://{self.ip}{path}", response.status, response.reason, response.headers, None)
+            return data
+
+
+_pools_lock = threading.Lock()
+_pools: dict[str, ConnectionPool] = {}
+
+
+def pool_for(ip) -> ConnectionPool:
+    with _pools_lock:
+        pool = _pools.get(ip)
+        if pool is None:
+            pool = _pools[ip] = ConnectionPool(ip)
+        return pool
+
+
+def close_pool(ip):
+    with _pools_lock:
+        pool = _pools.pop(ip, None)
+    if pool is not None:
+        pool.close()
+
+
+def query_document(ip, path_id, timeout=None):
+    """
+    List the documents of the folder `path_id`, which also makes it the web interface's current folder
+    """
     headers = {}
     headers.update(HEADERS__CONTENT_TYPE__JSON)
     headers.update(HEADERS__CHARSET__ISO88591)
-    url = f"{base_url}/documents/{path_id}"
-    req = request.Request(url)
-    for k, v in headers.items():
-        req.add_header(k, v)
-    with request.urlopen(req, **kwargs) as conn:
-        return json.loads(conn.read())
+    pool = pool_for(ip)
+    try:
+        response = pool.request("GET", f"/documents/{path_id}", headers=headers, timeout=timeout)
+    except:  # noqa: E722
+        pool.current_folder = None
+        raise
+    pool.current_folder = path_id
+    return json.loads(response)
+
+
+def position_folder(ip, folder_id):
+    """
+    Make `folder_id` the folder uploads go to, skipping the request if it already is the current folder
+    """
+    if pool_for(ip).current_folder == folder_id:
+        return
+    resp = query_document(ip, folder_id)
+    logging.getLogger().debug(f"{resp=}")
 
 
-# class NonRaisingHTTPErrorProcessor(request.HTTPErrorProcessor):
-#    http_response = https_response = lambda self, request, response: response
+def forget_position(ip):
+    """The web interface's current folder is not known anymore (eg. concurrent listings, xochitl restarted)"""
+    pool_for(ip).current_folder = None
 
 
-def upload_file(ip, local_path, folder_id, visible_name, **kwargs):
+def upload_file(ip, local_path, folder_id, visible_name, progress_callback=None, timeout=None):
+    """Upload the book to the folder `folder_id`, or to the current folder of the web interface if `folder_id` is None"""
     base_url = f"http://{ip}"
     headers = {
         "Origin": f"{base_url}",
@@ -205,24 +470,90 @@ def upload_file(ip, local_path, folder_id, visible_name, **kwargs):
     }
 
     # position pointer on folder
-    resp = query_document(ip, folder_id)
-    logging.getLogger().debug(f"{resp=}")
+    if folder_id is not None:
+        position_folder(ip, folder_id)
 
     # upload
     with open(local_path, "rb") as fp:
-        url = f"{base_url}/upload"
         form = MultiPartForm()
         form.add_file("file", visible_name, fp)
-        data = bytes(form)
-        req = request.Request(url, data=data)
-        for k, v in headers.items():
-            req.add_header(k, v)
-        req.add_header("Content-Length", len(data))
-        req.add_header("Content-Type", form.get_content_type())
-        # opener = request.build_opener(NonRaisingHTTPErrorProcessor)
-        # with opener.open(req, **kwargs) as conn:
-        with request.urlopen(req, **kwargs) as conn:
-            return json.loads(conn.read())
+        content_length = len(form)
+        headers["Content-Length"] = str(content_length)
+        headers["Content-Type"] = form.get_content_type()
+
+        def body():
+            fp.seek(0)
+            return report_progress(form.iter_chunks(), content_length, progress_callback)
+
+        pool = pool_for(ip)
+        try:
+            return json.loads(pool.request("POST", "/upload", body=body, headers=headers, timeout=timeout))
+        except:  # noqa: E722
+            pool.current_folder = None
+            raise
+
+
+@dataclasses.dataclass
+class UploadResult:
+    local_path: str
+    response: object = None
+    error: Exception | None = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def upload_files(
+    ip, uploads: list[tuple[str, str, str]], max_workers=UPLOAD_MAX_WORKERS, on_complete=None, progress_callback=None
+) -> list[UploadResult]:
+    """
+    Upload each (local_path, folder_id, visible_name) with at most `max_workers` transfers in flight.
+    The web interface has a single current folder: sequential uploads (`max_workers` 1) are grouped by folder so that
+    a folder is positioned once. Parallel uploads all go to whatever folder is current, the caller moves them to
+    their folder afterwards.
+    A failed upload does not stop the others, results are returned in input order.
+    `on_complete(index, result)` is called as soon as each upload ends,
+    `progress_callback(index, bytes_sent, total)` while each upload is sent.
+    """
+    results: list[UploadResult] = [None] * len(uploads)  # type: ignore
+
+    def complete(index: int, result: UploadResult):
+        results[index] = result
+        if on_complete:
+            on_complete(index, result)
+
+    def upload(index: int, position=True):
+        local_path, folder_id, visible_name = uploads[index]
+        report = (lambda sent, total: progress_callback(index, sent, total)) if progress_callback else None
+        try:
+            folder_id = folder_id if position else None
+            result = UploadResult(local_path, response=upload_file(ip, local_path, folder_id, visible_name, progress_callback=report))
+        except Exception as e:
+            logging.getLogger().warning(f"Unable to upload {local_path}", exc_info=True)
+            result = UploadResult(local_path, error=e)
+        complete(index, result)
+
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda index: upload(index, position=False), range(len(uploads))))
+        return results
+
+    indexes_per_folder: dict[str, list[int]] = {}
+    for index, (_, folder_id, _) in enumerate(uploads):
+        indexes_per_folder.setdefault(folder_id, []).append(index)
+
+    for folder_id, indexes in indexes_per_folder.items():
+        try:
+            position_folder(ip, folder_id)
+        except Exception as e:
+            logging.getLogger().warning(f"Unable to open folder {folder_id}", exc_info=True)
+            for index in indexes:
+                complete(index, UploadResult(uploads[index][0], error=e))
+            continue
+        for index in indexes:
+            upload(index)
+    return results
 
 
 def check_connection(ip: str):
@@ -234,17 +565,52 @@ def check_connection(ip: str):
         return False
 
 
-def query_tree(ip, path_id):
-    document_list_jsond = query_document(ip, path_id)
+def query_children(ip, path_id, **kwargs) -> list[Document]:
+    document_list_jsond = query_document(ip, path_id, **kwargs)
+    return list(sorted((Document.parse(r) for r in document_list_jsond), key=lambda d: d.Parent))
+
+
+def query_tree(ip, path_id, max_workers=QUERY_TREE_MAX_WORKERS, cancelled: threading.Event | None = None):
+    """
+    Crawl the document tree breadth-first: all the collections of a level are fetched in parallel
+    (at most `max_workers` requests in flight) before moving on to the next level.
+    The crawl stops with CancelledError between two levels once `cancelled` is set
+    """
     root = Node.new_empty()
-    id_to_obj = {path_id: root}
-    documents: list[Document] = list(sorted((Document.parse(r) for r in document_list_jsond), key=lambda d: d.Parent))
-    for d in documents:
-        id_to_obj[d.ID] = d
-        node = ChildNode([], document=d)
-        id_to_obj[d.Parent].children.append(node)
-        if d.Type == TypeOfDocument.CollectionType:
-            cc = query_tree(ip, d.ID).children
-            node.children.extend(cc)
+    level: list[tuple[Node, str]] = [(root, path_id)]
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while level:
+                if cancelled is not None and cancelled.is_set():
+                    raise CancelledError(f"crawl of {ip} cancelled")
+                documents_per_node = executor.map(lambda item: query_children(ip, item[1]), level)
+                next_level: list[tuple[Node, str]] = []
+                for (parent, _), documents in zip(level, documents_per_node):
+                    for d in documents:
+                        node = ChildNode([], document=d)
+                        parent.children.append(node)
+                        if d.Type == TypeOfDocument.CollectionType:
+                            next_level.append((node, d.ID))
+                level = next_level
+    finally:
+        # the listings ran concurrently, which one the web interface ended on is unknown
+        forget_position(ip)
 
     return root
+
+
+def load_recursive(ip, tree: Node, max_workers=QUERY_TREE_MAX_WORKERS) -> Node:
+    """
+    Fetch the lazy folders of `tree` that are not loaded yet, breadth-first and in parallel like query_tree
+    """
+    level: list[Node] = [tree]
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while level:
+                next_level: list[Node] = []
+                for children in executor.map(lambda node: node.children, level):
+                    next_level.extend(c for c in children if c.document.Type == TypeOfDocument.CollectionType)
+                level = next_level
+    finally:
+        forget_position(ip)
+    return tree
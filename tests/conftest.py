@@ -0,0 +1,72 @@
+"""
+The plugin modules are imported as the package `calibre_remarkable_usb_device`, without running its __init__ (the calibre plugin class).
+calibre has to be importable (rm_data uses its BookList), eg. run `python -m pytest tests` with the python calibre runs on.
+"""
+import json
+import os
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "calibre_remarkable_usb_device"
+
+if PACKAGE not in sys.modules:
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [ROOT]
+    sys.modules[PACKAGE] = package
+
+
+class WebInterface:
+    """Local stand-in of the USB web interface: serves the listings of `tree` (folder id -> documents), counts the requests"""
+
+    def __init__(self, tree: dict[str, list[dict]]):
+        self.tree = tree
+        self.requests: list[tuple[str, str]] = []
+        self.uploaded_bytes = 0
+        interface = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status: int, body: bytes):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                interface.requests.append(("GET", self.path))
+                self._respond(200, json.dumps(interface.tree.get(self.path[len("/documents/") :], [])).encode("utf-8"))
+
+            def do_POST(self):
+                interface.requests.append(("POST", self.path))
+                remaining = int(self.headers.get("Content-Length", 0))
+                while remaining > 0:
+                    remaining -= len(self.rfile.read(min(remaining, 64 * 1024)))
+                    interface.uploaded_bytes = int(self.headers["Content-Length"]) - remaining
+                self._respond(201, b"{}")
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.ip = f"127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def web_interface():
+    interface = WebInterface({"": []})
+    yield interface
+    interface.close()
+    from calibre_remarkable_usb_device import rm_web_interface
+
+    rm_web_interface.close_pool(interface.ip)
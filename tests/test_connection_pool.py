@@ -0,0 +1,46 @@
+import socket
+import threading
+
+from calibre_remarkable_usb_device import rm_web_interface
+
+
+def _one_request_per_connection():
+    """Server answering a single request per connection, then closing it while announcing keep-alive"""
+    server = socket.create_server(("127.0.0.1", 0))
+    connections = []
+    closed = threading.Semaphore(0)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            connections.append(conn)
+            request = b""
+            while b"\r\n\r\n" not in request:
+                request += conn.recv(65536)
+            head, _, body = request.partition(b"\r\n\r\n")
+            length = next((int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length:")), 0)
+            while len(body) < length:
+                body += conn.recv(65536)
+            conn.sendall(b"HTTP/1.1 201 Created\r\nContent-Length: 2\r\nConnection: keep-alive\r\n\r\n{}")
+            conn.close()
+            closed.release()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server, connections, closed
+
+
+def test_connection_closed_by_the_device_is_not_reused():
+    server, connections, closed = _one_request_per_connection()
+    pool = rm_web_interface.ConnectionPool(f"127.0.0.1:{server.getsockname()[1]}")
+    try:
+        pool.request("POST", "/upload")
+        closed.acquire(timeout=5)
+        # sent in one piece: on the dropped connection it would only fail on the response, and a POST is not retried then
+        assert pool.request("POST", "/upload") == b"{}"
+        assert len(connections) == 2
+    finally:
+        pool.close()
+        server.close()
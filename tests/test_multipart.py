@@ -0,0 +1,54 @@
+import tracemalloc
+
+from calibre_remarkable_usb_device import rm_web_interface
+
+
+def _book(tmp_path, size: int):
+    path = tmp_path / f"book-{size}.pdf"
+    with open(path, "wb") as fp:
+        fp.truncate(size)
+    return str(path)
+
+
+def _peak_upload_memory(ip, local_path):
+    tracemalloc.start()
+    try:
+        rm_web_interface.upload_file(ip, local_path, None, "book.pdf")
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_body_matches_content_length(tmp_path):
+    local_path = _book(tmp_path, 3 * rm_web_interface.UPLOAD_CHUNK_SIZE + 17)
+    with open(local_path, "rb") as fp:
+        form = rm_web_interface.MultiPartForm()
+        form.add_file("file", "book.pdf", fp)
+        body = bytes(form)
+    assert len(body) == len(form)
+    assert body.startswith(b"--" + form.boundary + b"\r\n")
+    assert body.endswith(b"--" + form.boundary + b"--\r\n")
+
+
+def test_progress_reports_every_chunk(tmp_path):
+    local_path = _book(tmp_path, 3 * rm_web_interface.UPLOAD_CHUNK_SIZE)
+    reports = []
+    with open(local_path, "rb") as fp:
+        form = rm_web_interface.MultiPartForm()
+        form.add_file("file", "book.pdf", fp)
+        total = len(form)
+        for _ in rm_web_interface.report_progress(form.iter_chunks(), total, lambda sent, total: reports.append((sent, total))):
+            pass
+    assert reports[-1] == (total, total)
+    assert [sent for sent, _ in reports] == sorted(sent for sent, _ in reports)
+
+
+def test_upload_memory_stays_flat(tmp_path, web_interface):
+    """The peak memory of an upload does not depend on the size of the book"""
+    small = _peak_upload_memory(web_interface.ip, _book(tmp_path, 4 * 1024 * 1024))
+    large = _peak_upload_memory(web_interface.ip, _book(tmp_path, 64 * 1024 * 1024))
+
+    assert web_interface.uploaded_bytes > 64 * 1024 * 1024
+    # a handful of chunks in flight, whatever the size
+    assert large < 2 * 1024 * 1024
+    assert large - small < 20 * rm_web_interface.UPLOAD_CHUNK_SIZE
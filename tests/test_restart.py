@@ -0,0 +1,125 @@
+import threading
+
+from calibre_remarkable_usb_device import rm_restart
+from calibre_remarkable_usb_device.rm_data import RemarkableSettings
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def _scheduler(clock: FakeClock, restarts: list, connection_checks=None):
+    def check_connection(ip):
+        return connection_checks.pop(0) if connection_checks else True
+
+    return rm_restart.RestartScheduler(
+        RemarkableSettings("10.11.99.1", ""),
+        delay=5.0,
+        clock=clock,
+        sleep=clock.sleep,
+        restart=restarts.append,
+        check_connection=check_connection,
+        start_thread=False,
+    )
+
+
+def test_requests_are_coalesced_after_the_last_one():
+    clock, restarts = FakeClock(), []
+    scheduler = _scheduler(clock, restarts)
+    for now in (0.0, 2.0, 4.0):
+        clock.now = now
+        scheduler.request_restart()
+
+    clock.now = 8.9
+    assert not scheduler.poll()
+    clock.now = 9.0
+    assert scheduler.poll()
+    assert not scheduler.poll()
+    assert len(restarts) == 1
+    assert not scheduler.pending
+
+
+def test_no_restart_while_held():
+    clock, restarts = FakeClock(), []
+    scheduler = _scheduler(clock, restarts)
+    scheduler.request_restart()
+    with scheduler.hold():
+        clock.now = 60.0
+        assert not scheduler.poll()
+        with scheduler.hold():
+            assert not scheduler.poll()
+        assert not scheduler.poll()
+    assert scheduler.poll()
+    assert len(restarts) == 1
+
+
+def test_flush_and_cancel():
+    clock, restarts = FakeClock(), []
+    scheduler = _scheduler(clock, restarts)
+    assert not scheduler.flush()
+    scheduler.request_restart()
+    assert scheduler.flush()
+    scheduler.request_restart()
+    scheduler.cancel()
+    clock.now = 60.0
+    assert not scheduler.poll()
+    assert len(restarts) == 1
+
+
+def test_wait_until_ready_polls_the_web_interface():
+    clock, restarts = FakeClock(), []
+    scheduler = _scheduler(clock, restarts, connection_checks=[False, False, True])
+    assert scheduler.wait_until_ready(timeout=10.0, interval=1.0)
+    assert clock.now == 0.0, "nothing to wait for before a restart"
+
+    scheduler.request_restart()
+    scheduler.flush()
+    assert scheduler.wait_until_ready(timeout=10.0, interval=1.0)
+    assert clock.now == 2.0
+
+
+def test_wait_until_ready_times_out():
+    clock, restarts = FakeClock(), []
+    scheduler = _scheduler(clock, restarts, connection_checks=[False] * 100)
+    scheduler.request_restart()
+    scheduler.flush()
+    assert not scheduler.wait_until_ready(timeout=10.0, interval=1.0)
+    assert clock.now == 10.0
+
+
+def test_wait_until_ready_waits_for_the_restart_command():
+    clock, restarted, release = FakeClock(), threading.Event(), threading.Event()
+    checks = []
+
+    def restart(settings):
+        restarted.set()
+        release.wait()
+
+    def check_connection(ip):
+        checks.append(release.is_set())
+        return True
+
+    scheduler = rm_restart.RestartScheduler(
+        RemarkableSettings("10.11.99.1", ""), clock=clock, sleep=clock.sleep, restart=restart, check_connection=check_connection, start_thread=False
+    )
+    scheduler.request_restart()
+    restarting = threading.Thread(target=scheduler.flush)
+    restarting.start()
+    try:
+        restarted.wait()
+        waiting = threading.Thread(target=scheduler.wait_until_ready)
+        waiting.start()
+        waiting.join(0.2)
+        assert waiting.is_alive(), "the web interface that answers is still the one being stopped"
+    finally:
+        release.set()
+        restarting.join()
+    waiting.join()
+    assert checks == [True]